@@ -1,38 +1,73 @@
 from numpy import *
 import unittest
 import scipy.optimize as opt
+import scipy.sparse as sparse
+from scipy.sparse.linalg import svds
+from numpy.random import RandomState
 import copy as cp
+import cPickle as pickle
+import functools
+import gzip
+import hashlib
+import inspect
+import multiprocessing
+import os
+import shutil
+import site
+import sqlite3
+import sys
+import tempfile
+import time
+import types
+import warnings
+from distutils import sysconfig
+from xml.sax.saxutils import escape, quoteattr
 import matplotlib.pyplot as plt
 from matplotlib import scale as mscale
 from matplotlib import transforms as mtransforms
 import matplotlib.figure as fig
 import matplotlib.axes as maxes
+from matplotlib.patches import Rectangle
 from pylab import *
 import tkFileDialog as tkfd
+from sasarray import range_mask, data_columns
 
 class SasData(object):
     """Root class for data object for holding 1-d Q versus I SAS data.
 
     Class has a series of methods for initialising and
     doing basic operations on SAS data. The root class
-    is very simple and only contains the Q and I lists
+    is very simple and only contains the Q and I arrays
     providing simple addition, multiplication, length
     and string operations.
+
+    The class uses __slots__ so instances have no __dict__, and the
+    data are held as float64 arrays (or float32 if asked for with
+    dtype), contiguous unless they are views made by wrap_array. The q
+    array is a read-only copy so objects derived from this one, by
+    addition or multiplication, can share it rather than holding
+    copies of their own.
     """
 
-    def __init__(self, q_vals, i_vals):
+    __slots__ = ('q', 'i')
+
+    def __init__(self, q_vals, i_vals, dtype=float64):
         """Initializing the SasData object.
 
-        Just passes two lists to the initializing object which
-        are then stored internally. Possibly an argument for 
-        including the units of Q in the root object
+        Takes two lists or arrays which are converted to arrays of
+        dtype and stored internally. An i array which is already of the
+        right dtype is not copied, so a column of a larger array stays a
+        view of it. q is copied into a read-only array unless it is
+        read-only already, like the q of another SasData object.
+        Possibly an argument for including the units of Q in the root
+        object
         """
 
         assert type(q_vals) == list or type(q_vals) == ndarray
         assert type(i_vals) == list or type(i_vals) == ndarray
         assert len(q_vals) == len(i_vals), 'q and i not the same length'
-        self.q = q_vals
-        self.i = i_vals
+        self.q = read_only_array(q_vals, dtype)
+        self.i = asarray(i_vals, dtype=dtype)
 
 
     def __len__(self):
@@ -46,11 +81,11 @@ class SasData(object):
         where two SasData objects are added together where the wish is
         for the intensities of both to be combined. The second cases is
         when adding (or more likely subtracting) a numeric value (float 
-        or int) which is handled separately. Probably both of these could
-        be written neater and faster.
+        or int) which is handled separately.
 
         Inputs must required are a SasData object and either a SasData object or
-        an int or float. Returns a new SasData object.
+        an int or float. Returns a new SasData object sharing q with this
+        one.
         """
 
         assert isinstance(self, SasData)
@@ -60,39 +95,70 @@ class SasData(object):
         # addition of two SasData objects
         if isinstance(other, SasData):
             assert len(self) == len(other), 'datasets not the same length'
-	    assert self.q == other.q, 'q values not the same'
-
-            # initialize a SasData object with zero for all intensities
-	    out = SasData(self.q, ([0] * len(self)))
-	    for j in range(len(self)):
-                out.i[j] = self.i[j] + other.i[j]
+            assert (self.q is other.q or array_equal(self.q, other.q)
+                    ), 'q values not the same'
 
-	    return out
+            return SasData(self.q, self.i + other.i, self.i.dtype)
 
         # addition of a float or int to  SasData objects
         elif type(other) is int or type(other) is float:
-            out = SasData(self.q, ([0]*len(self)))
-	    for j in range(len(self)):
-	        out.i[j] = self.i[j] + other
-
-	    return out
+            return SasData(self.q, self.i + other, self.i.dtype)
 
 
     def __mul__(self, other):
         """Basic mutplication function for SasData objects.
 
         Requires a SasData object and an int or a float. Returns a new
-        SasData object.
+        SasData object sharing q with this one.
         """
 
         assert isinstance(self, SasData) 
         assert type(other) is int or type(other) is float
  
-        # initialize a SasData object with zero for all intensities 
-        out = SasData(self.q, (([0] * len(self)))) 
-        for j in range(len(self)):
-            out.i[j] = self.i[j] * other
-	return out
+        return SasData(self.q, self.i * other, self.i.dtype)
+
+
+    def __getstate__(self):
+        """Returns the slot values so objects can be pickled.
+
+        Classes with __slots__ and no __getstate__ can only be pickled
+        with protocol 2 and above.
+        """
+
+        state = {}
+        for cls in type(self).__mro__:
+            for name in getattr(cls, '__slots__', ()):
+                state[name] = getattr(self, name)
+
+        return state
+
+
+    def __setstate__(self, state):
+        for name, value in state.items():
+            setattr(self, name, value)
+
+        # unpickled arrays are new so q can be made read-only again
+        self.q.flags.writeable = False
+
+
+def read_only_array(values, dtype=float64):
+    """Returns values as a read-only array of dtype.
+
+    Read-only arrays of the right dtype are returned unchanged, which
+    is what lets SasData objects share q. Anything else, including a
+    writeable array, is copied into a new array which is made read-only,
+    so the values cannot be changed afterwards through the caller's
+    array either.
+    """
+
+    if (isinstance(values, ndarray) and values.dtype == dtype
+            and not values.flags.writeable):
+        return values
+
+    values = array(values, dtype=dtype)
+    values.flags.writeable = False
+
+    return values
 
 
 class ExpSasData(SasData):
@@ -104,13 +170,61 @@ class ExpSasData(SasData):
     the experimental data. 
     """
 
-    def __init__(self, q, i):
-        """Initialization routine adds additional SasData object for the 
-        masked data at self.masked"""
+    __slots__ = ('idev', 'qdev', 'smearing', 'model_q', 'mask', 'masked')
+
+    def __init__(self, q, i, idev=None, qdev=None, dtype=float64):
+        """Initialization routine sets up the mask and the masked data
+        at self.masked, both None until make_mask and apply_mask are
+        called. The uncertainties in I and Q (Idev and Qdev in canSAS
+        terms) are optional and are None if unknown. model_q is only set
+        on masked data, see apply_mask."""
+
+        SasData.__init__(self, q, i, dtype)
+        if idev is not None:
+            assert len(idev) == len(q), 'idev and q not the same length'
+            idev = asarray(idev, dtype=dtype)
+        if qdev is not None:
+            assert len(qdev) == len(q), 'qdev and q not the same length'
+            qdev = asarray(qdev, dtype=dtype)
+        self.idev = idev
+        self.qdev = qdev
+        self.smearing = None
+        self.model_q = None
+        self.mask = None
+        self.masked = None
+
+    def resolution(self, cutoff=3.):
+        """Returns the smearing matrix for the Q resolution of the data.
+
+        The matrix is built by smearing_matrix from self.qdev the first
+        time it is asked for and then kept, so fitting routines can call
+        this on every fit without rebuilding it. The kept matrix is
+        checked against a hash of q and qdev, so it is rebuilt if they
+        or the cutoff change, even if an array is changed in place.
+        Returns None when there is no Qdev or all of it is zero, in which
+        case no smearing is needed.
+
+        For masked data made by apply_mask the matrix is the rows of the
+        unmasked data's matrix for the points that are kept. It maps the
+        model on the full q grid, self.model_q, onto the kept points, so
+        points next to a masked range are smeared the same as before.
+        """
 
-        SasData.__init__(self, q, i)
-        self.mask = []
-        self.masked = SasData([],[])
+        if self.model_q is not None:
+            return self.smearing[1]
+
+        if self.qdev is None or not (self.qdev > 0).any():
+            return None
+
+        digest = hashlib.sha1()
+        digest.update(ascontiguousarray(self.q).data)
+        digest.update(ascontiguousarray(self.qdev).data)
+        key = (cutoff, digest.hexdigest())
+        if self.smearing is None or self.smearing[0] != key:
+            self.smearing = (key,
+                             smearing_matrix(self.q, self.qdev, cutoff))
+
+        return self.smearing[1]
 
     #################################################
     #
@@ -119,46 +233,36 @@ class ExpSasData(SasData):
     #################################################
 
     def make_mask(self, mask_ranges):
-        """Generates a mask list of 0's and 1's to remove data in mask_ranges
+        """Generates a boolean mask array to remove data in mask_ranges
 
-        Takes a SasData object and creates a list with a 1 to 1 mapping with
-        SasData.q containing only zeros and ones based on the q-values in
-        mask_ranges. Mask_ranges takes the form of a list of length N of
-        lists of length two containing data to exclude. May expand in the future
-        to allow both positive and negative mask generation.
+        Takes a SasData object and creates a boolean array with a 1 to 1
+        mapping with SasData.q which is False for q-values in mask_ranges
+        and True elsewhere. Mask_ranges takes the form of a list of length
+        N of lists of length two containing data to exclude. May expand
+        in the future to allow both positive and negative mask generation.
         """
 
-    # need to make an assertion that mask ranges is a N x 2 set of lists
-    # not immediately sure how to do this at the moment
-
-    # make a copy of the q list because we are going to change it
-        mask = cp.deepcopy(self.q)
-        
-        for j in range(0, len(mask)):
-
-            #for each pair of values in mask_ranges
-            for low, high in mask_ranges:
-                # check whether q values are within mask_ranges
-                if self.q[j] >= low and self.q[j] <= high:
-                    mask[j] = 0
-                    break
-                else:
-                    mask[j] = 1
-
-        self.mask = mask
+        self.mask = range_mask(self.q, mask_ranges)
 
     def apply_mask(self):
         """Applies a pre-calculated mask to a SasData object.
 
         Takes the pre-calculated mask from make_mask and creates a new
         SasData object with the masked data points (those corresponding
-        to zeros in the mask) removed. The new object is then placed in
-        self.masked. In principle this should allow nested masking operations.
-        Whether this is a good idea remains to be seen.
+        to False, or zeros, in the mask) removed. The new object is then
+        placed in self.masked. In principle this should allow nested
+        masking operations. Whether this is a good idea remains to be seen.
+
+        If the data has a Q resolution the masked data keeps the rows of
+        the smearing matrix for the points that are kept and the full q
+        grid in masked.model_q. Fitting routines evaluate the model on
+        model_q and smear it with these rows, rather than rebuilding the
+        smearing on the gapped q grid, which would cut the resolution
+        function off at the edges of the masked ranges.
         """
 
-        assert type(self.mask) is list, 'Mask needs to be a list'
-        assert self.mask != None, 'Mask appears not to have been setup'
+        assert isinstance(self.mask, (list, ndarray)
+                          ), 'Mask needs to be an array or a list'
         assert len(self.mask) != 0, 'Mask is zero length?'
         assert len(self.mask
                      ) == len(self.q), 'Mask not same length as data?'
@@ -166,10 +270,418 @@ class ExpSasData(SasData):
         q_masked = extract(self.mask, self.q)
         i_masked = extract(self.mask, self.i)
 
-        self.masked =  SasData(q_masked, i_masked)
+        # carry the uncertainties across so the masked data can be smeared
+        idev_masked = None
+        qdev_masked = None
+        if self.idev is not None:
+            idev_masked = extract(self.mask, self.idev)
+        if self.qdev is not None:
+            qdev_masked = extract(self.mask, self.qdev)
+
+        self.masked =  ExpSasData(q_masked, i_masked,
+                                  idev_masked, qdev_masked, self.i.dtype)
+
+        resolution = self.resolution()
+        if resolution is not None:
+            self.masked.model_q = self.q
+            if self.model_q is not None:
+                self.masked.model_q = self.model_q
+            self.masked.smearing = (None,
+                                    resolution[flatnonzero(self.mask)])
+
         return self.masked
 
 
+##################################################
+#
+# Conversion between N x 2 arrays and SasData objects
+#
+##################################################
+
+def wrap_array(data, dtype=None):
+    """Wraps an N x 2 or N x 3 array in an ExpSasData object without copying.
+
+    The columns of data are taken as q, i and, if there is a third
+    column, idev. The ExpSasData object holds views of the columns so
+    no data is copied, and changes to i show up in the original array.
+    q is a read-only view but the original array is left writeable,
+    so unlike other SasData objects q changes if the q column of the
+    original array is changed. The data is only copied if dtype is
+    given and differs from the dtype of the array, or if the array is
+    not floating point, when it is converted to float64 so that
+    arithmetic on the object is not truncated.
+    """
+
+    data = asarray(data, dtype=dtype)
+    if data.dtype.kind != 'f':
+        data = asarray(data, dtype=float64)
+    assert data.ndim == 2 and data.shape[1] in (2, 3
+            ), 'data should be an N x 2 or N x 3 array'
+
+    idev = None
+    if data.shape[1] == 3:
+        idev = data[:,2]
+
+    # a read-only view is used as it is rather than copied
+    q = data[:,0].view()
+    q.flags.writeable = False
+
+    return ExpSasData(q, data[:,1], idev, dtype=data.dtype)
+
+
+##################################################
+#
+# Merging overlapping curves from several detectors or distances
+#
+##################################################
+
+def interpolate_rows(q_new, q, values, errors=False):
+    """Linearly interpolates every row of a 2-D array onto q_new.
+
+    All the rows share the q values so the interpolation indices and
+    weights are found once and applied to the whole array. q_new must
+    lie within the range of q, which must be in ascending order. If
+    errors is True the rows are taken as the standard errors of
+    independent points and are propagated through the interpolation
+    rather than interpolated.
+    """
+
+    q = asarray(q, dtype=float)
+    upper = clip(searchsorted(q, q_new), 1, len(q) - 1)
+    lower = upper - 1
+    fraction = (q_new - q[lower]) / (q[upper] - q[lower])
+
+    if errors:
+        return sqrt((values[:, lower] * (1. - fraction))**2
+                    + (values[:, upper] * fraction)**2)
+
+    return values[:, lower] * (1. - fraction) + values[:, upper] * fraction
+
+
+def merge_collections(collections, offset=False, reference=0, q_grid=None):
+    """Merges collections of runs taken at several detectors or distances.
+
+    collections is a list with one entry per detector (or distance),
+    each a list of SasData objects sharing one set of q values, so that
+    the j'th object in every collection together make up one run. For
+    each pair of detectors that overlap in q the scale factor (and the
+    offset if offset is True) bringing one onto the other is found by
+    weighted linear least squares in the overlap, for all runs at once.
+    The weights combine the errors of both curves, those of the upper
+    curve scaled by the factor being fitted, so the fit is repeated a
+    few times with the latest factor. The factors are chained so that
+    every detector is put on the scale of the reference detector.
+
+    The scaled curves are then combined on q_grid, by default the union
+    of all the q values. Each detector only contributes at the q values
+    it measured, so that no measurement is counted twice, and points
+    measured by more than one detector are averaged weighted by
+    1/Idev**2 (or equally if there is no Idev). Grid points which no
+    detector measured are interpolated, propagating the errors, though
+    neighbouring interpolated points are then correlated. Returns a
+    list of merged ExpSasData objects, one per run, and the scale
+    factors and offsets applied to each detector as arrays with one
+    row per run.
+    """
+
+    n_detectors = len(collections)
+    assert n_detectors > 1, 'need at least two collections to merge'
+    n_runs = len(collections[0])
+    for collection in collections:
+        assert len(collection) == n_runs, 'collections not the same length'
+
+    # stack the runs of each detector into 2-D arrays
+    q = []
+    i = []
+    idev = []
+    for collection in collections:
+        q_k = asarray(collection[0].q, dtype=float)
+        for data in collection:
+            assert (data.q is collection[0].q or array_equal(data.q, q_k)
+                    ), 'q values not the same within a collection'
+        q.append(q_k)
+        i.append(array([data.i for data in collection], dtype=float))
+        if all([getattr(data, 'idev', None) is not None
+                for data in collection]):
+            idev.append(array([data.idev for data in collection],
+                              dtype=float))
+        else:
+            idev.append(None)
+    has_errors = all([errors is not None for errors in idev])
+
+    scales = ones((n_runs, n_detectors))
+    offsets = zeros((n_runs, n_detectors))
+
+    # work up in q, scaling each detector onto the one below it
+    order = argsort([q_k[0] for q_k in q])
+    for below, above in zip(order[:-1], order[1:]):
+        low = max(q[below][0], q[above][0])
+        high = min(q[below][-1], q[above][-1])
+        overlap = (q[below] >= low) & (q[below] <= high)
+        assert overlap.sum() >= 1 + offset, 'curves do not overlap enough'
+
+        y = (i[below][:, overlap] * scales[:, below, newaxis]
+             + offsets[:, below, newaxis])
+        x = interpolate_rows(q[below][overlap], q[above], i[above])
+        weights = ones(y.shape)
+        n_passes = 1
+        if has_errors:
+            variance_y = (idev[below][:, overlap]
+                          * scales[:, below, newaxis])**2
+            variance_x = interpolate_rows(q[below][overlap], q[above],
+                                          idev[above], errors=True)**2
+            n_passes = 4
+
+        factor = y.sum(axis=1) / x.sum(axis=1)
+        for fit_pass in range(n_passes):
+            if has_errors:
+                weights = 1. / (variance_y
+                                + factor[:, newaxis]**2 * variance_x)
+
+            sum_w = weights.sum(axis=1)
+            sum_x = (weights * x).sum(axis=1)
+            sum_y = (weights * y).sum(axis=1)
+            sum_xx = (weights * x * x).sum(axis=1)
+            sum_xy = (weights * x * y).sum(axis=1)
+
+            if offset:
+                factor = ((sum_w * sum_xy - sum_x * sum_y)
+                          / (sum_w * sum_xx - sum_x**2))
+                offsets[:, above] = (sum_y - factor * sum_x) / sum_w
+            else:
+                factor = sum_xy / sum_xx
+        scales[:, above] = factor
+
+    # put everything on the scale of the reference detector
+    offsets = ((offsets - offsets[:, reference, newaxis])
+               / scales[:, reference, newaxis])
+    scales = scales / scales[:, reference, newaxis]
+
+    # read-only so that all the merged runs share one q array
+    if q_grid is None:
+        q_grid = unique(concatenate(q))
+    q_grid = read_only_array(q_grid)
+
+    # the grid points each detector measured, and those none measured
+    measured = []
+    for k in range(n_detectors):
+        nearest = clip(searchsorted(q[k], q_grid), 0, len(q[k]) - 1)
+        measured.append(isclose(q[k][nearest], q_grid, rtol=1e-9, atol=0.))
+    unmeasured = ~any(measured, axis=0)
+
+    # error weighted average of every detector on the merged grid
+    sum_w = zeros((n_runs, len(q_grid)))
+    sum_wi = zeros((n_runs, len(q_grid)))
+    for k in range(n_detectors):
+        inside = (q_grid >= q[k][0]) & (q_grid <= q[k][-1])
+        used = measured[k] | (unmeasured & inside)
+        scaled = interpolate_rows(q_grid[used], q[k], i[k])
+        scaled = scaled * scales[:, k, newaxis] + offsets[:, k, newaxis]
+        weights = ones(scaled.shape)
+        if has_errors:
+            errors = interpolate_rows(q_grid[used], q[k], idev[k],
+                                      errors=True)
+            weights = 1. / (errors * scales[:, k, newaxis])**2
+        sum_w[:, used] += weights
+        sum_wi[:, used] += weights * scaled
+
+    assert (sum_w > 0).all(), 'q_grid goes outside the data'
+    i_merged = sum_wi / sum_w
+    idev_merged = None
+    if has_errors:
+        idev_merged = 1. / sqrt(sum_w)
+
+    merged = []
+    for j in range(n_runs):
+        errors = None
+        if has_errors:
+            errors = idev_merged[j]
+        merged.append(ExpSasData(q_grid, i_merged[j], errors))
+
+    return merged, scales, offsets
+
+
+def merge_curves(curves, offset=False, reference=0, q_grid=None):
+    """Merges SasData objects taken at several detectors or distances.
+
+    Calls merge_collections with one run per detector. Returns the
+    merged ExpSasData object and the scale factor and offset applied
+    to each curve.
+    """
+
+    merged, scales, offsets = merge_collections(
+            [[data] for data in curves], offset, reference, q_grid)
+
+    return merged[0], scales[0], offsets[0]
+
+
+##################################################
+#
+# Singular value decomposition of collections of curves
+#
+##################################################
+
+def stack_curves(curves, dtype=float64):
+    """Stacks SasData objects sharing q into a 2-D array.
+
+    Returns the shared q values and an array with one row per curve.
+    """
+
+    q = curves[0].q
+    for data in curves:
+        assert (data.q is q or array_equal(data.q, q)
+                ), 'q values not the same for all curves'
+
+    return q, array([data.i for data in curves], dtype=dtype)
+
+
+def svd_stack(q, stack, n_components=None, method='full', mask_ranges=None,
+              block_size=1024, n_oversamples=10, n_iterations=2, seed=None):
+    """Singular value decomposition of a stack of curves sharing q.
+
+    stack has one row per curve and may be a numpy.memmap. The method
+    is one of
+
+    'full' - numpy.linalg.svd of the whole stack.
+    'truncated' - scipy.sparse.linalg.svds for the first n_components.
+    'randomized' - a randomised range finder with n_oversamples extra
+        vectors and n_iterations power iterations, which only needs a
+        few passes over the stack and suits very tall or wide stacks.
+    'blocked' - reads the stack block_size rows at a time, building the
+        q by q Gram matrix and then the left singular vectors, so the
+        stack never has to fit in memory. Small singular values are
+        less accurate than with the other methods as the Gram matrix
+        squares the condition number.
+
+    Q ranges in mask_ranges are left out, as for ExpSasData.make_mask.
+    Returns the q values used, the left singular vectors (one row per
+    curve), the singular values and the component curves (one row per
+    component), truncated to n_components if it is given.
+    """
+
+    assert method in ('full', 'truncated', 'randomized', 'blocked'
+                      ), 'unknown method'
+    q = asarray(q)
+    n_rows = len(stack)
+    assert shape(stack)[1] == len(q), 'stack and q not the same length'
+
+    columns = None
+    if mask_ranges is not None:
+        columns = range_mask(q, mask_ranges)
+        q = q[columns]
+
+    if n_components is None:
+        assert method in ('full', 'blocked'), 'n_components is needed'
+        n_components = min(n_rows, len(q))
+
+    def select(block):
+        if columns is None:
+            return asarray(block, dtype=float)
+        return asarray(block, dtype=float)[:, columns]
+
+    if method == 'blocked':
+        gram = zeros((len(q), len(q)))
+        for start in range(0, n_rows, block_size):
+            block = select(stack[start:start + block_size])
+            gram += dot(block.T, block)
+
+        values, vectors = linalg.eigh(gram)
+        order = argsort(values)[::-1][:n_components]
+        s = sqrt(clip(values[order], 0., None))
+        vt = vectors[:, order].T
+
+        u = empty((n_rows, len(s)))
+        inverse = zeros(len(s))
+        inverse[s > 0] = 1. / s[s > 0]
+        for start in range(0, n_rows, block_size):
+            block = select(stack[start:start + block_size])
+            u[start:start + block_size] = dot(block, vt.T) * inverse
+
+        return q, u, s, vt
+
+    a = select(stack)
+
+    if method == 'full':
+        u, s, vt = linalg.svd(a, full_matrices=False)
+
+    elif method == 'truncated':
+        u, s, vt = svds(a, n_components)
+        order = argsort(s)[::-1]
+        u, s, vt = u[:, order], s[order], vt[order]
+
+    else:
+        # randomised range finder with power iterations
+        n_vectors = min(n_components + n_oversamples, min(a.shape))
+        omega = RandomState(seed).standard_normal((len(q), n_vectors))
+        basis = linalg.qr(dot(a, omega))[0]
+        for iteration in range(n_iterations):
+            basis = linalg.qr(dot(a.T, basis))[0]
+            basis = linalg.qr(dot(a, basis))[0]
+        small_u, s, vt = linalg.svd(dot(basis.T, a), full_matrices=False)
+        u = dot(basis, small_u)
+
+    return (q, u[:, :n_components], s[:n_components],
+            vt[:n_components])
+
+
+def svd_curves(curves, n_components=None, method='full', mask_ranges=None,
+               **kwargs):
+    """Singular value decomposition of a list of SasData objects.
+
+    Stacks the curves with stack_curves and calls svd_stack, passing
+    any other keyword arguments through.
+    """
+
+    q, stack = stack_curves(curves)
+
+    return svd_stack(q, stack, n_components, method, mask_ranges, **kwargs)
+
+
+def svd_residuals(q, stack, u, s, vt, mask_ranges=None, block_size=1024):
+    """Diagnostics for how well the components describe a stack.
+
+    Reconstructs the stack from the components block_size rows at a
+    time, so neither the reconstruction nor the residuals are ever held
+    for the whole stack. mask_ranges should be the same as given to
+    svd_stack. Returns the root sum of squared residuals for each curve
+    and the fraction of the total sum of squares explained by the
+    first 1, 2, ... components.
+    """
+
+    q = asarray(q)
+    columns = None
+    if mask_ranges is not None:
+        columns = range_mask(q, mask_ranges)
+
+    weighted = u * s
+    residuals = empty(len(stack))
+    total = 0.
+    for start in range(0, len(stack), block_size):
+        block = asarray(stack[start:start + block_size], dtype=float)
+        if columns is not None:
+            block = block[:, columns]
+        total += (block**2).sum()
+        block = block - dot(weighted[start:start + block_size], vt)
+        residuals[start:start + block_size] = sqrt((block**2).sum(axis=1))
+
+    return residuals, cumsum(asarray(s)**2) / total
+
+
+def reconstruct_curve(q, u, s, vt, index, n_components=None):
+    """Returns curve index of a stack rebuilt from its first components.
+
+    Uses all the components given by svd_stack unless n_components is
+    set. The q values should be those returned by svd_stack.
+    """
+
+    if n_components is None:
+        n_components = len(s)
+
+    i = dot(u[index, :n_components] * s[:n_components], vt[:n_components])
+
+    return SasData(q, i)
+
+
 ##################################################
 #
 # Loaders for various SAS data formats to SasData objects
@@ -190,7 +702,9 @@ def load():
     DLS_I22_recogniser = 'Created at DLS-I22'
     sasxml_recogniser = 'cansas1d/1.0'
 
-    file = open(path, 'r').readlines()
+    sas_file = open_sas_file(path)
+    file = sas_file.readlines()
+    sas_file.close()
 
     for j in range(0,5):
         if DLS_I22_recogniser in file[j]:
@@ -214,10 +728,15 @@ def load_two_column_data(file, rows_to_skip=0):
     i22 files currently have two columns with three lines of text
     at the top. This just does a quick and dirty load of a the file
     into a SasData object. Currently setup to be called in the form
-    data = load_two_column_data('file')
+    data = load_two_column_data('file'). Gzip compressed files are
+    read transparently.
     """
 
-    data = loadtxt(file, skiprows = rows_to_skip)
+    data_file = open_sas_file(file)
+    try:
+        data = loadtxt(data_file, skiprows = rows_to_skip)
+    finally:
+        data_file.close()
 
 
 
@@ -225,52 +744,254 @@ def load_two_column_data(file, rows_to_skip=0):
     data_i = data[:,1]
     return ExpSasData(data_q, data_i)
 
-import xml.etree.ElementTree as ET
+try:
+    import xml.etree.cElementTree as ET
+except ImportError:
+    import xml.etree.ElementTree as ET
+
+def iter_sasxml(file, first=0):
+    """Yields an ExpSasData object for each SASentry of a SASxml 1.0 file.
+
+    The file is read with ElementTree.iterparse (the C version where
+    there is one) and each {cansas1d/1.0}Idata tag has the text of its
+    Q, I, Idev and Qdev tags converted to floats. Elements are cleared
+    as soon as they are read so memory use does not grow with the size
+    of the file, and a file with many entries can be read in one pass
+    by iterating over this. The values of entries before first are not
+    converted, which is how loadsasxml picks out one entry.
+    """
+
+    namespace = "{cansas1d/1.0}"
+    columns = {'Q' : [], 'I' : [], 'Idev' : [], 'Qdev' : []}
+    index = 0
+
+    source = open_sas_file(file)
+    try:
+        for event, element in ET.iterparse(source):
+            if element.tag == namespace + 'Idata':
+                if index >= first:
+                    for tag in columns:
+                        value = element.find(namespace + tag)
+                        if value is not None:
+                            # need to convert text to float
+                            columns[tag].append(float(value.text))
+                element.clear()
+
+            elif element.tag == namespace + 'SASdata':
+                element.clear()
+
+            elif element.tag == namespace + 'SASentry':
+                if index >= first:
+                    yield sasxml_data(columns)
+                columns = {'Q' : [], 'I' : [], 'Idev' : [], 'Qdev' : []}
+                index += 1
+                element.clear()
+    finally:
+        source.close()
+
+
+def sasxml_data(columns):
+    """Makes an ExpSasData object from the values read from one SASentry."""
+
+    q_list = columns['Q']
+    i_list = columns['I']
+
+    # check everything is ok with q_list and i_list
+    assert len(q_list) == len(i_list), 'different number of q and i values?'
+    assert len(q_list) != 0, 'appear to be no q values'
+    assert len(i_list) != 0, 'appear to be no i values'
+    assert q_list[0] < q_list[-1], 'q values not in order?'
 
-def loadsasxml(file):
+    # only keep the uncertainties if there is one for every point
+    idev_list = None
+    qdev_list = None
+    if len(columns['Idev']) == len(q_list):
+        idev_list = columns['Idev']
+    if len(columns['Qdev']) == len(q_list):
+        qdev_list = columns['Qdev']
+
+    # generate and return a SasData object
+    return ExpSasData(q_list, i_list, idev_list, qdev_list)
+
+
+def loadsasxml(file, entry=0):
     """Loaded for SASxml 1.0 format data.
 
-    The loader uses xml.etree.ElementTree to parse the xml file and
-    then searches through the file to find the {cansas1d/1.0}Q and
-    {cansas1d/1,0}I tags and then extract the text attribute from each 
-    of these. The list is then converted from text to floats and the Q
-    and I lists passed to a new SasData object. Currently nothing else
-    from the sas xml folder is loaded.
+    Returns the selected SASentry (the first by default) as an
+    ExpSasData object with Q and I and, when every data point has them,
+    Idev and Qdev. Reading stops at the end of the selected entry and
+    the values of earlier entries are skipped. To read every entry of a
+    file use iter_sasxml, which does it in one pass. Currently nothing
+    else from the sas xml folder is loaded.
     """
 
     # Check that file is a sasxml file
     # assert (first line of file is what it should be) is True
 
-    # Parse the xml file and find the root element
-    tree = ET.parse('xmltest.xml')
-    elem = tree.getroot()
+    entries = iter_sasxml(file, entry)
+    try:
+        for data in entries:
+            return data
+    finally:
+        entries.close()
 
-    # return a list of all the <Q> tags and get the Q values
-    q_tags = elem.getiterator("{cansas1d/1.0}Q")
+    raise AssertionError('no SASentry %d in file' % entry)
 
-    q_list = []
 
-    for elements in q_tags:
-        q_list.append(float(elements.text)) # need to convert text to float
+    
 
-    # then do the same for the <I> tags and values
-    i_tags = elem.getiterator("{cansas1d/1.0}I")
-    i_list = []
+##################################################
+#
+# Writers for SasData objects to various SAS data formats
+#
+##################################################
 
-    for elements in i_tags:
-        i_list.append(float(elements.text))
+def open_sas_file(file, mode='r', compress=None):
+    """Opens a data file for reading or writing handling gzip compression.
 
-    # check everything is ok with q_list and i_list
-    assert len(q_list) == len(i_list), 'different number of q and i values?'
-    assert len(q_list) != 0, 'appear to be no q values'
-    assert len(i_list) != 0, 'appear to be no i values'
-    assert q_list[0] < q_list[-1], 'q values not in order?'
+    When reading, compress=None checks the start of the file for the
+    gzip magic number so compressed files are found whatever they are
+    called. When writing, compress=None compresses if the file name ends
+    in .gz. Setting compress to True or False overrides both.
+    """
 
-    # generate and return a SasData object
-    return ExpSasData(q_list, i_list)
+    if compress is None:
+        if 'r' in mode:
+            test_file = open(file, 'rb')
+            compress = test_file.read(2) == '\x1f\x8b'
+            test_file.close()
+        else:
+            compress = file.endswith('.gz')
 
+    if compress:
+        return gzip.open(file, mode[0] + 'b')
+    return open(file, mode)
+
+
+def write_formatted_rows(file_object, row_format, columns, block_size=4096):
+    """Writes columns of numbers to an open file using a row format string.
+
+    Rather than formatting each row in a python loop, the row format is
+    repeated for a whole block of rows and applied to the flattened block
+    in one string formatting operation. Blocks are written as they are
+    made so memory use stays small however long the columns are. The
+    row_format should contain one conversion per column and end in a
+    newline.
+    """
+
+    table = column_stack([asarray(column, dtype=float) for column in columns])
+
+    for start in range(0, len(table), block_size):
+        block = table[start:start + block_size]
+        file_object.write(
+                (row_format * len(block)) % tuple(block.ravel().tolist()))
+
+
+def save_two_column_data(data, file, header=None, format='%.6e',
+                         compress=None):
+    """Writer for two column (Q and I) data files.
+
+    Writes the q and i values of a SasData object as two whitespace
+    separated columns. The optional header is a list of lines written
+    at the top of the file, so a file written with a three line header
+    is read back with load_two_column_data(file, 3). The file is gzip
+    compressed if it ends in .gz or compress is True.
+    """
+
+    assert isinstance(data, SasData)
+
+    out = open_sas_file(file, 'w', compress)
+    try:
+        if header is not None:
+            for line in header:
+                out.write(line.rstrip('\n') + '\n')
+
+        write_formatted_rows(out, '\t%s\t%s\n' % (format, format),
+                             [data.q, data.i])
+    finally:
+        out.close()
+
+
+def savesasxml(data, file, names=None, q_unit='1/A', i_unit='1/cm',
+               format='%.6e', compress=None, radiation='x-ray'):
+    """Writer for SASxml 1.0 format data.
+
+    Takes a SasData object, or a list of them, and writes each one as a
+    separate SASentry in a single canSAS 1D file. Idev and Qdev are
+    written for objects which have them. Names for each SASentry can be
+    given as a list and are also used for the Title. The data block of
+    each entry is formatted in bulk by write_formatted_rows rather than
+    built up as an element tree. Each entry gets the minimal SASsample
+    and SASinstrument elements the cansas1d/1.0 schema requires, with
+    the sample ID set to the name and the given radiation type. The
+    file is gzip compressed if it ends in .gz or compress is True.
+    """
+
+    if isinstance(data, SasData):
+        data = [data]
+    if names is None:
+        names = ['entry_%d' % j for j in range(len(data))]
+    assert len(names) == len(data), 'need one name for each SasData object'
+
+    # the units go into the row format, so any % in them is escaped
+    q_attribute = quoteattr(q_unit).replace('%', '%%')
+    i_attribute = quoteattr(i_unit).replace('%', '%%')
+
+    out = open_sas_file(file, 'w', compress)
+    try:
+        out.write('<?xml version="1.0"?>\n'
+                  '<SASroot version="1.0"\n'
+                  '         xmlns="cansas1d/1.0"\n'
+                  '         xmlns:xsi='
+                  '"http://www.w3.org/2001/XMLSchema-instance"\n'
+                  '         xsi:schemaLocation="cansas1d/1.0 '
+                  'http://svn.smallangles.net/svn/canSAS/1dwg/trunk/'
+                  'cansas1d.xsd">\n')
+
+        for j in range(len(data)):
+            assert isinstance(data[j], SasData)
+
+            # build the format for one <Idata> from the columns we have
+            columns = [data[j].q, data[j].i]
+            row_format = ('  <Idata><Q unit=%s>%s</Q><I unit=%s>%s</I>'
+                          % (q_attribute, format, i_attribute, format))
+
+            idev = getattr(data[j], 'idev', None)
+            if idev is not None:
+                columns.append(idev)
+                row_format += ('<Idev unit=%s>%s</Idev>'
+                               % (i_attribute, format))
+
+            qdev = getattr(data[j], 'qdev', None)
+            if qdev is not None:
+                columns.append(qdev)
+                row_format += ('<Qdev unit=%s>%s</Qdev>'
+                               % (q_attribute, format))
+
+            row_format += '</Idata>\n'
+
+            out.write(' <SASentry name=%s>\n' % quoteattr(names[j]))
+            out.write(' <Title>%s</Title>\n' % escape(names[j]))
+            out.write(' <Run>%d</Run>\n' % j)
+            out.write(' <SASdata>\n')
+            write_formatted_rows(out, row_format, columns)
+            out.write(' </SASdata>\n')
+
+            # minimal sample and instrument elements required by the schema
+            out.write(' <SASsample><ID>%s</ID></SASsample>\n'
+                      % escape(names[j]))
+            out.write(' <SASinstrument>\n'
+                      '  <name></name>\n'
+                      '  <SASsource><radiation>%s</radiation></SASsource>\n'
+                      '  <SAScollimation/>\n'
+                      '  <SASdetector><name></name></SASdetector>\n'
+                      ' </SASinstrument>\n' % escape(radiation))
+            out.write(' </SASentry>\n')
+
+        out.write('</SASroot>\n')
+    finally:
+        out.close()
 
-    
 
 ###################################################
 #
@@ -388,6 +1109,68 @@ mscale.register_scale(SquaredScale)
 
               
 
+###################################################
+#
+# Instrument resolution smearing
+#
+###################################################
+
+def smearing_matrix(q, qdev, cutoff=3., max_points=25):
+    """Builds a sparse matrix that smears a model by the Q resolution.
+
+    Each row of the matrix is a Gaussian of width qdev centred on one
+    q value, weighted by the spacing of the q points and normalised to
+    one, so that resolution.dot(model(q, param)) gives the smeared
+    model. The Gaussian is cut off at cutoff standard deviations which
+    makes the matrix banded and it is stored as a scipy.sparse csr
+    matrix. Points with a qdev of zero are not smeared. The q values
+    must be in ascending order.
+
+    For finely sampled data the band can hold far more points than are
+    needed to sample the Gaussian, making smeared fits much slower than
+    unsmeared ones. Each row only uses every n'th point of its band,
+    counting out from the centre so the sampling stays symmetric, with
+    n chosen so the row has at most max_points points. The smeared
+    model then differs from using the whole band by about as much as
+    the cut off does. max_points=None uses the whole band.
+    """
+
+    q = asarray(q, dtype=float)
+    qdev = asarray(qdev, dtype=float)
+    assert len(q) == len(qdev), 'q and qdev not the same length'
+    assert (diff(q) >= 0).all(), 'q values not in order?'
+
+    # find the band of q values within the cutoff of each point
+    width = cutoff * qdev
+    low = searchsorted(q, q - width, 'left')
+    high = searchsorted(q, q + width, 'right')
+    centre = arange(len(q))
+
+    # thin out the bands to at most max_points, out from the centre
+    stride = ones(len(q), dtype=int)
+    if max_points is not None:
+        stride = maximum(1, -(-(high - low) // max_points))
+    below = (centre - low) // stride
+    counts = below + (high - 1 - centre) // stride + 1
+
+    # lay out the band for every row end to end in one set of arrays
+    rows = repeat(centre, counts)
+    offsets = cumsum(counts) - counts
+    cols = rows + (arange(counts.sum()) - offsets[rows]
+                   - below[rows]) * stride[rows]
+
+    sigma = qdev[rows]
+    sigma[sigma == 0] = 1.
+    weights = exp(-0.5 * ((q[cols] - q[rows]) / sigma)**2)
+    if len(q) > 1:
+        weights *= gradient(q)[cols]
+
+    # normalise each row so the smearing conserves intensity
+    weights /= bincount(rows, weights, len(q))[rows]
+
+    return sparse.csr_matrix((weights, (rows, cols)), shape=(len(q), len(q)))
+
+
 ###################################################
 #
 # Definition of data fitting models
@@ -413,21 +1196,841 @@ def guinier_residuals(param, i, q):
     return err
 
 
-def fit_guinier(data):
+def model_residuals(param, model, i, q, resolution=None):
+    """Calculates the residuals for a fit of any model to a dataset.
+
+    The model is called as model(q, param). If a resolution (smearing)
+    matrix is given the model is smeared with it before the residuals
+    are calculated, in which case q is the grid the model is evaluated
+    on and may be longer than i.
+    """
+
+    calc = model(q, param)
+    if resolution is not None:
+        calc = resolution.dot(calc)
+
+    return i - calc
+
+
+def model_grid(data, smear=True):
+    """Returns the q values to evaluate a model on and the smearing matrix.
+
+    Without smearing the model is evaluated at data.q. For masked data
+    with a resolution the model is evaluated on the full q grid of the
+    unmasked data, see ExpSasData.apply_mask.
+    """
+
+    resolution = None
+    q = data.q
+    if smear and isinstance(data, ExpSasData):
+        resolution = data.resolution()
+        if resolution is not None and data.model_q is not None:
+            q = data.model_q
+
+    return asarray(q, dtype=float), resolution
+
+
+def fit_model(data, model, param_0, smear=True):
+    """Function for fitting any model to a dataset with leastsq.
+
+    Where data is an ExpSasData object with Qdev the model is smeared
+    by the instrument resolution during the fit unless smear is False.
+    The smearing matrix is cached on the data object so repeat fits of
+    the same data do not rebuild it. Returns the leastsq output.
+    """
+
+    assert isinstance(data, SasData)
+
+    q, resolution = model_grid(data, smear)
+
+    least_squares_fit = opt.leastsq(
+            model_residuals, param_0,
+            args=(model, asarray(data.i, dtype=float), q, resolution))
+
+    return least_squares_fit
+
+
+def fit_guinier(data, smear=True):
     """Function for calling to get a Guinier fit to a dataset
 
     This currently takes a dataset and sets some plausible initial values
-    for a Guinier fit before calling guinier_residuals using leastsq.
+    for a Guinier fit before calling fit_model, which smears the model
+    by the Q resolution of the data if it has any.
     """
 
     assert isinstance(data, SasData) 
 
     param_0 = [1.,1.,0.] # Set reasonable initial values for Guinier fit
            
-    least_squares_fit = opt.leastsq(
-            guinier_residuals, param_0, args=(data.i, data.q))
+    return fit_model(data, guinier, param_0, smear)
+
+
+###################################################
+#
+# Resampling estimates of fit uncertainties
+#
+###################################################
+
+def evaluate_model_batch(model, q, param, resolution=None):
+    """Evaluates a model for many parameter sets at once.
+
+    param is an array with one row of parameters per curve. The model
+    is called once with each parameter as a column so that numpy
+    broadcasting returns a 2-D array with one row per curve; models
+    written with array operations, like guinier, work unchanged.
+    """
+
+    calc = model(q, param.T[:, :, newaxis])
+    calc = calc * ones((len(param), len(q)))
+    if resolution is not None:
+        calc = resolution.dot(calc.T).T
+
+    return calc
+
+
+def fit_model_batch(i_stack, q, model, param_0, resolution=None,
+                    max_iterations=100, tolerance=1e-12):
+    """Fits a model to a 2-D stack of curves sharing q values.
+
+    Runs a Levenberg-Marquardt fit on every row of i_stack at the same
+    time. Jacobians are found by forward differences from one batched
+    model evaluation per parameter and the damped normal equations are
+    solved for all curves in one call, so the python overhead is per
+    iteration rather than per curve. Curves stop being updated once
+    their sum of squares stops improving. param_0 is either one set of
+    starting values or one row per curve. With a resolution matrix q is
+    the grid the model is evaluated on, as returned by model_grid.
+
+    Returns the fitted parameters with one row per curve and a boolean
+    array which is False for curves whose fit did not converge within
+    max_iterations or whose sum of squares or parameters are not
+    finite, for example because the curve contains a NaN. The
+    parameters of those curves should not be used.
+    """
+
+    i_stack = atleast_2d(asarray(i_stack, dtype=float))
+    q = asarray(q, dtype=float)
+    n_curves = len(i_stack)
+    param = ones((n_curves, 1)) * asarray(param_0, dtype=float)
+    n_params = param.shape[1]
+
+    damping = ones(n_curves) * 1e-3
+    chi2 = ((i_stack - evaluate_model_batch(
+                model, q, param, resolution))**2).sum(axis=1)
+    active = arange(n_curves)
+    converged = zeros(n_curves, dtype=bool)
+
+    for iteration in range(max_iterations):
+        if len(active) == 0:
+            break
+
+        p = param[active]
+        i_active = i_stack[active]
+        calc = evaluate_model_batch(model, q, p, resolution)
+        residuals = i_active - calc
+
+        # forward difference jacobian, one batched evaluation per parameter
+        jacobian = empty((len(active), i_stack.shape[1], n_params))
+        for k in range(n_params):
+            step = 1.49e-8 * maximum(abs(p[:, k]), 1.)
+            shifted = p.copy()
+            shifted[:, k] += step
+            jacobian[:, :, k] = (evaluate_model_batch(
+                    model, q, shifted, resolution) - calc) / step[:, newaxis]
+
+        # damped normal equations for every active curve together
+        alpha = einsum('snk,snl->skl', jacobian, jacobian)
+        beta = einsum('snk,sn->sk', jacobian, residuals)
+        scale = alpha[:, arange(n_params), arange(n_params)]
+        alpha[:, arange(n_params), arange(n_params)] += (
+                damping[active, newaxis] * scale + 1e-30)
+        delta = linalg.solve(alpha, beta[:, :, newaxis])[:, :, 0]
+
+        trial = p + delta
+        trial_chi2 = ((i_active - evaluate_model_batch(
+                model, q, trial, resolution))**2).sum(axis=1)
+
+        better = trial_chi2 < chi2[active]
+        improvement = chi2[active] - trial_chi2
+        param[active[better]] = trial[better]
+        chi2[active[better]] = trial_chi2[better]
+        damping[active[better]] /= 10.
+        damping[active[~better]] *= 10.
+
+        # curves are finished when a step no longer changes the fit
+        done = (better & (improvement <= tolerance * chi2[active])) | (
+                damping[active] > 1e10) | (chi2[active] == 0)
+        finished = active[done]
+        converged[finished] = isfinite(chi2[finished]) & (
+                isfinite(param[finished]).all(axis=1))
+        active = active[~done]
+
+    return param, converged
+
+
+def fit_model_batch_worker(args):
+    """Unpacks arguments for fit_model_batch when run in a process pool."""
+
+    return fit_model_batch(*args)
+
+
+def bootstrap_fit(data, model, param_0, n_samples=1000, method='residual',
+                  confidence=0.95, smear=True, processes=None, seed=None):
+    """Estimates uncertainties of fitted parameters by resampling.
+
+    The data is first fitted with fit_model. All the resampled curves
+    are then made at once as a 2-D array, either by adding residuals
+    of the fit drawn with replacement to the fitted curve (method is
+    'residual') or by adding Gaussian noise of size Idev to the data
+    (method is 'monte_carlo'), and fitted together with fit_model_batch
+    starting from the best fit. If processes is given the resampled
+    curves are split between that many worker processes. Resampled
+    fits which do not converge are left out, with a warning giving how
+    many there were.
+
+    Returns the best fit parameters, the standard deviation of the
+    resampled parameters, the lower and upper confidence limits as a
+    2 row array, and the parameters for every resampled curve whose
+    fit converged.
+    """
+
+    assert isinstance(data, SasData)
+    assert method in ('residual', 'monte_carlo'), 'unknown method'
+
+    q, resolution = model_grid(data, smear)
+    i = asarray(data.i, dtype=float)
+
+    best = fit_model(data, model, param_0, smear)[0]
+    random_state = RandomState(seed)
+
+    if method == 'residual':
+        residuals = model_residuals(best, model, i, q, resolution)
+        picks = random_state.randint(0, len(i), (n_samples, len(i)))
+        i_stack = (i - residuals) + residuals[picks]
+    else:
+        assert getattr(data, 'idev', None) is not None, 'No Idev for data'
+        i_stack = i + asarray(data.idev, dtype=float) * (
+                random_state.standard_normal((n_samples, len(i))))
+
+    if processes is None:
+        samples, converged = fit_model_batch(i_stack, q, model, best,
+                                             resolution)
+    else:
+        chunks = array_split(i_stack, processes)
+        pool = multiprocessing.Pool(processes)
+        try:
+            results = pool.map(fit_model_batch_worker,
+                    [(chunk, q, model, best, resolution)
+                     for chunk in chunks])
+        finally:
+            pool.close()
+            pool.join()
+        samples = vstack([result[0] for result in results])
+        converged = concatenate([result[1] for result in results])
+
+    if not converged.all():
+        warnings.warn('%d of %d resampled fits did not converge and were '
+                      'left out' % ((~converged).sum(), n_samples),
+                      RuntimeWarning)
+    assert converged.any(), 'no resampled fits converged'
+    samples = samples[converged]
+
+    tail = 50. * (1. - confidence)
+    interval = percentile(samples, [tail, 100. - tail], axis=0)
+
+    return best, samples.std(axis=0), interval, samples
+
+
+def bootstrap_guinier(data, n_samples=1000, method='residual', **kwargs):
+    """Function for getting uncertainties on I0, Rg and background.
+
+    Calls bootstrap_fit with the Guinier model and the same initial
+    values as fit_guinier. Other keyword arguments are passed through.
+    """
+
+    return bootstrap_fit(data, guinier, [1.,1.,0.], n_samples, method,
+                         **kwargs)
+
+###################################################
+#
+# Persistent cache of fit results
+#
+###################################################
+
+def code_version():
+    """Returns a hash of the source of this module.
+
+    Used as part of the FitCache keys so that results are refitted
+    whenever the fitting code changes.
+    """
+
+    digest = hashlib.sha1()
+    try:
+        source = open(os.path.splitext(__file__)[0] + '.py', 'rb')
+        digest.update(source.read())
+        source.close()
+    except (IOError, NameError):
+        pass
+
+    return digest.hexdigest()
+
+
+def code_names(code):
+    """Returns the global and attribute names used by code.
+
+    Includes the names used by any functions, lambdas or generator
+    expressions defined within it.
+    """
+
+    names = set(code.co_names)
+    for constant in code.co_consts:
+        if hasattr(constant, 'co_code'):
+            names |= code_names(constant)
+
+    return names
+
+
+def library_module(name):
+    """Returns True if the module called name is installed with Python.
+
+    That is a built in module or one in the standard library or a
+    site-packages directory, as opposed to the user's own code.
+    """
+
+    module = sys.modules.get(name)
+    path = getattr(module, '__file__', None)
+    if path is None:
+        return name in sys.builtin_module_names
+
+    path = os.path.realpath(path)
+    libraries = [sysconfig.get_python_lib(), site.USER_SITE,
+                 sysconfig.get_python_lib(standard_lib=True)]
+    return any([path.startswith(os.path.realpath(library) + os.sep)
+                for library in libraries if library])
+
+
+def hash_value(digest, value, seen=None):
+    """Adds anything that can be passed to a fitting routine to a hash.
+
+    Arrays are hashed by their dtype, shape and raw data, SasData
+    objects by their arrays (including any mask) and functions by
+    their name, compiled code, default arguments, the contents of their
+    closure cells and the values of the globals they use, so that the
+    hash changes when a module constant or a helper function changes.
+    Functions from installed libraries such as numpy, and built in
+    functions and methods, are only hashed by name, as their globals or
+    the objects they are bound to can hold state such as that of the
+    random number generator.
+    Bound methods are hashed with the object they are bound to, and
+    other objects by their class, the functions it defines and their
+    __dict__, or failing that by pickling them. Lists, tuples and dicts
+    are hashed item by item and numbers, strings, classes and modules
+    by their repr or name.
+
+    The hash must be the same in every session, so TypeError is raised
+    for anything which can only be told apart by its address. seen
+    holds the ids of the functions and objects being hashed, so that
+    recursive references are only hashed once.
+    """
+
+    if seen is None:
+        seen = set()
+
+    if isinstance(value, ndarray):
+        value = ascontiguousarray(value)
+        digest.update('array %s %s ' % (value.dtype.str, value.shape))
+        digest.update(value.data)
+
+    elif isinstance(value, SasData):
+        digest.update('%s ' % type(value).__name__)
+        for name in ['q', 'i', 'idev', 'qdev', 'model_q', 'mask']:
+            digest.update(name + ' ')
+            hash_value(digest, getattr(value, name, None), seen)
+
+    elif hasattr(value, '__code__'):
+        digest.update('function %s.%s ' % (value.__module__,
+                                           value.__name__))
+        if id(value) in seen:
+            return
+        seen.add(id(value))
+        if getattr(value, '__self__', None) is not None:
+            digest.update('bound to ')
+            hash_value(digest, value.__self__, seen)
+        if library_module(value.__module__):
+            return
+
+        hash_value(digest, value.__code__, seen)
+        hash_value(digest, value.__defaults__, seen)
+        for cell in value.__closure__ or ():
+            hash_value(digest, cell.cell_contents, seen)
+
+        namespace = value.__globals__
+        for name in sorted(code_names(value.__code__)):
+            if name in namespace:
+                digest.update('global %s ' % name)
+                hash_value(digest, namespace[name], seen)
+
+    elif hasattr(value, 'co_code'):
+        digest.update(value.co_code)
+        hash_value(digest, value.co_names, seen)
+        hash_value(digest, value.co_varnames, seen)
+        for constant in value.co_consts:
+            hash_value(digest, constant, seen)
+
+    elif isinstance(value, (list, tuple)):
+        digest.update('%s %d ' % (type(value).__name__, len(value)))
+        for item in value:
+            hash_value(digest, item, seen)
+
+    elif isinstance(value, dict):
+        digest.update('dict %d ' % len(value))
+        for item in sorted(value.items()):
+            hash_value(digest, item, seen)
+
+    elif isinstance(value, (type(None), type(Ellipsis), bool, int, long,
+                            float, complex, basestring, generic, type,
+                            types.ClassType)):
+        digest.update(repr(value) + ' ')
+
+    elif isinstance(value, types.ModuleType):
+        digest.update('module %s ' % value.__name__)
+
+    elif isinstance(value, ufunc):
+        digest.update('ufunc %s ' % value.__name__)
+
+    elif isinstance(value, types.BuiltinFunctionType):
+        digest.update('builtin %s ' % value.__name__)
+
+    elif isinstance(value, functools.partial):
+        digest.update('partial ')
+        hash_value(digest, (value.func, value.args, value.keywords or {}),
+                   seen)
+
+    elif hasattr(value, '__dict__'):
+        cls = value.__class__
+        digest.update('instance %s.%s ' % (cls.__module__, cls.__name__))
+        if id(value) in seen:
+            return
+        seen.add(id(value))
+        for base in inspect.getmro(cls):
+            hash_value(digest, [item for name, item
+                                in sorted(vars(base).items())
+                                if isinstance(item, types.FunctionType)],
+                       seen)
+        hash_value(digest, vars(value), seen)
+
+    else:
+        try:
+            digest.update(pickle.dumps(value, 2))
+        except (pickle.PicklingError, TypeError):
+            raise TypeError('cannot hash %s objects for the fit cache'
+                            % type(value).__name__)
+
+
+class FitCache(object):
+    """Persistent on-disk cache of fit results.
+
+    Results are stored in an sqlite database, keyed by a hash of the
+    fitting routine, the data (intensities, q, errors and mask), every
+    other argument such as the model, starting values and settings, and
+    the version of this module. Fitting the same data the same way again,
+    in this session or a later one, returns the stored result instead of
+    refitting. sqlite locking makes it safe for several processes to
+    share one cache file. When the stored results grow past max_size
+    bytes the least recently used ones are removed.
+    """
+
+    def __init__(self, path=None, max_size=100 * 2**20, timeout=60.):
+        """Opens the cache at path, creating it if needed.
+
+        The default path is .sas_fit_cache.db in the home directory.
+        timeout is how long in seconds to wait for another process
+        holding a lock on the cache.
+        """
+
+        if path is None:
+            path = os.path.join(os.path.expanduser('~'), '.sas_fit_cache.db')
+        self.path = path
+        self.max_size = max_size
+        self.timeout = timeout
+        self.version = code_version()
+        self.hits = 0
+        self.misses = 0
+
+        connection = self.connect()
+        try:
+            connection.execute('PRAGMA journal_mode=WAL')
+            connection.execute('CREATE TABLE IF NOT EXISTS fits '
+                               '(key TEXT PRIMARY KEY, result BLOB, '
+                               'size INTEGER, used REAL)')
+            connection.execute('CREATE INDEX IF NOT EXISTS fits_used '
+                               'ON fits (used)')
+        finally:
+            connection.close()
+
+    def connect(self):
+        """Opens a new connection to the database in autocommit mode.
+
+        A connection is opened for each operation so a cache object can
+        be used on both sides of a fork.
+        """
+
+        return sqlite3.connect(self.path, timeout=self.timeout,
+                               isolation_level=None)
+
+    def key(self, fitter, data, *args, **kwargs):
+        """Returns the key for fitting data with fitter and the arguments."""
+
+        digest = hashlib.sha1(self.version)
+        hash_value(digest, (fitter, data, args, kwargs))
+
+        return digest.hexdigest()
+
+    def get(self, key):
+        """Returns (True, result) if key is in the cache or (False, None).
+
+        Marks the result as recently used.
+        """
+
+        connection = self.connect()
+        try:
+            row = connection.execute('SELECT result FROM fits WHERE key = ?',
+                                     (key,)).fetchone()
+            if row is None:
+                return False, None
+            connection.execute('UPDATE fits SET used = ? WHERE key = ?',
+                               (time.time(), key))
+        finally:
+            connection.close()
+
+        return True, pickle.loads(str(row[0]))
+
+    def put(self, key, result):
+        """Stores result under key, removing old results if over max_size."""
+
+        blob = pickle.dumps(result, pickle.HIGHEST_PROTOCOL)
+
+        connection = self.connect()
+        try:
+            connection.execute('BEGIN IMMEDIATE')
+            try:
+                connection.execute('INSERT OR REPLACE INTO fits '
+                                   'VALUES (?, ?, ?, ?)',
+                                   (key, sqlite3.Binary(blob), len(blob),
+                                    time.time()))
+
+                # remove least recently used results until under max_size
+                total = connection.execute(
+                        'SELECT SUM(size) FROM fits').fetchone()[0]
+                if total > self.max_size:
+                    rows = connection.execute('SELECT key, size FROM fits '
+                                              'ORDER BY used').fetchall()
+                    for old_key, size in rows:
+                        if total <= self.max_size or old_key == key:
+                            break
+                        connection.execute('DELETE FROM fits WHERE key = ?',
+                                           (old_key,))
+                        total -= size
+                connection.execute('COMMIT')
+            except:
+                connection.execute('ROLLBACK')
+                raise
+        finally:
+            connection.close()
+
+    def call(self, fitter, data, *args, **kwargs):
+        """Returns fitter(data, *args, **kwargs), from the cache if possible.
+
+        Works with fit_guinier, fit_model, bootstrap_fit or any other
+        fitting routine taking the data as its first argument. If any of
+        the arguments cannot be hashed the fit is done without the cache,
+        with a warning, rather than risk returning another fit's result.
+        """
+
+        try:
+            key = self.key(fitter, data, *args, **kwargs)
+        except TypeError as error:
+            warnings.warn('not caching fit: %s' % error, RuntimeWarning)
+            return fitter(data, *args, **kwargs)
+        found, result = self.get(key)
+        if found:
+            self.hits += 1
+            return result
+
+        self.misses += 1
+        result = fitter(data, *args, **kwargs)
+        self.put(key, result)
+
+        return result
+
+    def fit_guinier(self, data, smear=True):
+        """Cached version of fit_guinier."""
+
+        return self.call(fit_guinier, data, smear)
+
+    def clear(self):
+        """Removes every result from the cache."""
+
+        connection = self.connect()
+        try:
+            connection.execute('DELETE FROM fits')
+        finally:
+            connection.close()
+
+
+###################################################
+#
+# Interactive mask editing
+#
+###################################################
+
+class MaskEditor(object):
+    """Interactive editing of the mask of an ExpSasData object.
+
+    Plots the data with a model fitted to the points that are not
+    masked. Dragging across the plot with the left mouse button masks
+    the points in that q range and dragging with the right button
+    unmasks them. Pressing 'u', which matplotlib does not bind, clears
+    the mask. After each change the model is refitted starting from the
+    previous fit.
+
+    The mask on the data object is a boolean array which is updated in
+    place for just the points in the dragged range, as are the arrays
+    behind the plotted lines. The lines, the fit and the drag region
+    are animated artists redrawn by blitting over a saved background,
+    so the axes are not redrawn. ExpSasData.apply_mask can be called
+    afterwards to get the masked data, and mask_ranges gives the ranges
+    to pass to make_mask.
+
+    Passing a figure with a FigureCanvasAgg canvas allows the editor to
+    be driven without a display by sending it events.
+    """
+
+    def __init__(self, data, model=guinier, param_0=[1.,1.,0.], smear=True,
+                 figure=None, format='ro', max_markers=2000):
+        """Sets up the plot, connects the events and does the first fit.
+
+        Drawing markers is the slowest part of an update, so for curves
+        with more than max_markers points only every n'th marker is
+        drawn. There are still more markers than pixels across the plot.
+        """
+
+        assert isinstance(data, ExpSasData)
+        assert data.model_q is None, 'edit the mask of the unmasked data'
+        assert (diff(data.q) >= 0).all(), 'q values not in order?'
+
+        self.data = data
+        self.model = model
+        self.q = asarray(data.q, dtype=float)
+        self.i = asarray(data.i, dtype=float)
+        if data.mask is None or len(data.mask) != len(data):
+            data.mask = ones(len(data), dtype=bool)
+        else:
+            data.mask = asarray(data.mask, dtype=bool)
+
+        self.resolution = None
+        if smear:
+            self.resolution = data.resolution()
+
+        # copies of i with nan for points which are not plotted
+        self.kept_i = where(data.mask, self.i, nan)
+        self.excluded_i = where(data.mask, nan, self.i)
+
+        if figure is None:
+            figure = plt.figure()
+        self.figure = figure
+        self.canvas = figure.canvas
+        self.axes = figure.add_subplot(1,1,1)
+        self.axes.set_ylabel('I')
+        self.axes.set_xlabel('Q')
+
+        step = max(1, len(self.q) // max_markers)
+        self.kept_line, = self.axes.plot(self.q, self.kept_i, format,
+                                         markevery=step, animated=True)
+        self.excluded_line, = self.axes.plot(self.q, self.excluded_i, 'x',
+                                             color='0.6', markevery=step,
+                                             animated=True)
+        self.fit_line, = self.axes.plot(self.q, zeros(len(self.q)), 'k-',
+                                        animated=True)
+        self.span = Rectangle((0, 0), 0, 1, alpha=0.3, visible=False,
+                              transform=self.axes.get_xaxis_transform(),
+                              animated=True)
+        self.axes.add_patch(self.span)
+        self.axes.set_xlim(self.q[0], self.q[-1])
+        finite = self.i[isfinite(self.i)]
+        if len(finite) != 0:
+            self.axes.set_ylim(finite.min(), finite.max())
+
+        self.param = asarray(param_0, dtype=float)
+        self.press_q = None
+        self.press_button = None
+        self.background = None
+        self.update_time = 0.
+
+        self.connections = [
+            self.canvas.mpl_connect('draw_event', self.on_draw),
+            self.canvas.mpl_connect('button_press_event', self.on_press),
+            self.canvas.mpl_connect('motion_notify_event', self.on_motion),
+            self.canvas.mpl_connect('button_release_event', self.on_release),
+            self.canvas.mpl_connect('key_press_event', self.on_key)]
+
+        self.refit()
+        self.canvas.draw()
+
+    def disconnect(self):
+        """Stops the editor responding to events."""
+
+        for connection in self.connections:
+            self.canvas.mpl_disconnect(connection)
+
+    #################################################
+    #
+    # Drawing
+    #
+    #################################################
+
+    def on_draw(self, event):
+        """Saves the background after a full draw for later blitting."""
+
+        self.background = self.canvas.copy_from_bbox(self.axes.bbox)
+        self.draw_artists()
+
+    def draw_artists(self):
+        for artist in [self.excluded_line, self.kept_line, self.fit_line,
+                       self.span]:
+            self.axes.draw_artist(artist)
+
+    def blit(self):
+        """Redraws the animated artists over the saved background."""
+
+        if self.background is None:
+            self.canvas.draw()
+            return
+
+        self.canvas.restore_region(self.background)
+        self.draw_artists()
+        self.canvas.blit(self.axes.bbox)
+
+    #################################################
+    #
+    # Masking and fitting
+    #
+    #################################################
+
+    def set_range(self, low, high, keep):
+        """Masks (keep is False) or unmasks the points from low to high.
+
+        Only the points in the range are touched in the mask and the
+        plotted arrays. The model is then refitted and the plot blitted.
+        """
+
+        start_time = time.time()
+
+        low, high = min(low, high), max(low, high)
+        start = searchsorted(self.q, low, 'left')
+        stop = searchsorted(self.q, high, 'right')
+
+        self.data.mask[start:stop] = keep
+        if keep:
+            self.kept_i[start:stop] = self.i[start:stop]
+            self.excluded_i[start:stop] = nan
+        else:
+            self.kept_i[start:stop] = nan
+            self.excluded_i[start:stop] = self.i[start:stop]
+        self.kept_line.set_ydata(self.kept_i)
+        self.excluded_line.set_ydata(self.excluded_i)
+
+        self.refit()
+        self.blit()
+
+        self.update_time = time.time() - start_time
+
+    def reset(self):
+        """Clears the mask."""
+
+        self.set_range(self.q[0], self.q[-1], True)
+
+    def refit(self):
+        """Refits the model to the points which are not masked.
+
+        The fit starts from the last fitted parameters so only a few
+        iterations are needed after a small change to the mask. With
+        resolution smearing the model is smeared at every q and the
+        unmasked points picked out, rather than taking the rows of the
+        smearing matrix for them, which costs more than the fit.
+        """
+
+        mask = self.data.mask
+        if mask.sum() < len(self.param):
+            return
+
+        if self.resolution is None:
+            self.param = opt.leastsq(model_residuals, self.param, args=(
+                    self.model, self.i[mask], self.q[mask], None))[0]
+        else:
+            self.param = opt.leastsq(self.smeared_residuals, self.param)[0]
+
+        fit = self.model(self.q, self.param)
+        if self.resolution is not None:
+            fit = self.resolution.dot(fit)
+        self.fit_line.set_ydata(fit)
+
+    def smeared_residuals(self, param):
+        calc = self.resolution.dot(self.model(self.q, param))
+
+        return (self.i - calc)[self.data.mask]
+
+    def mask_ranges(self):
+        """Returns the masked q ranges as a list of [low, high] pairs."""
+
+        edges = diff(concatenate(([0], (~self.data.mask).astype(int), [0])))
+        starts = flatnonzero(edges == 1)
+        stops = flatnonzero(edges == -1) - 1
+
+        return [[self.q[start], self.q[stop]]
+                for start, stop in zip(starts, stops)]
+
+    #################################################
+    #
+    # Event handling
+    #
+    #################################################
+
+    def on_press(self, event):
+        if event.inaxes is not self.axes or event.button not in (1, 3):
+            return
+
+        self.press_q = event.xdata
+        self.press_button = event.button
+        self.span.set_x(event.xdata)
+        self.span.set_width(0)
+        self.span.set_visible(True)
+        self.blit()
+
+    def on_motion(self, event):
+        if self.press_q is None or event.inaxes is not self.axes:
+            return
+
+        self.span.set_width(event.xdata - self.press_q)
+        self.blit()
+
+    def on_release(self, event):
+        if self.press_q is None:
+            return
+
+        release_q = self.press_q + self.span.get_width()
+        if event.inaxes is self.axes:
+            release_q = event.xdata
+
+        self.span.set_visible(False)
+        self.set_range(self.press_q, release_q, self.press_button == 3)
+        self.press_q = None
+        self.press_button = None
+
+    def on_key(self, event):
+        if event.key == 'u':
+            self.reset()
 
-    return least_squares_fit
 
 ########################################
 #
@@ -458,8 +2061,8 @@ class TestSasData(unittest.TestCase):
 
 
     def test_init(self):
-	self.assertEqual(self.test_data_ranges.q, self.zero_to_nine)
-	self.assertEqual(self.test_data_ranges.i, self.nine_to_zero)
+	self.assertEqual(self.test_data_ranges.q.tolist(), self.zero_to_nine)
+	self.assertEqual(self.test_data_ranges.i.tolist(), self.nine_to_zero)
 
 	self.assertRaises(
                 AssertionError, SasData, self.test_string, self.test_zero)
@@ -479,13 +2082,13 @@ class TestSasData(unittest.TestCase):
 
         test_add = SasData(self.zero_to_nine, self.nine_to_zero)
 	test_add = self.test_data_ranges + self.test_data_ranges
-	self.assertEqual(self.eighteen_to_zero, test_add.i)
-	self.assertEqual(self.zero_to_nine, test_add.q)
+	self.assertEqual(self.eighteen_to_zero, test_add.i.tolist())
+	self.assertEqual(self.zero_to_nine, test_add.q.tolist())
 
         test_add = SasData(self.zero_to_nine, self.nine_to_zero)
 	test_add = self.test_data_ranges + 4
-	self.assertEqual(self.thirteen_to_four, test_add.i)
-	self.assertEqual(self.zero_to_nine, test_add.q)
+	self.assertEqual(self.thirteen_to_four, test_add.i.tolist())
+	self.assertEqual(self.zero_to_nine, test_add.q.tolist())
 
 	self.assertRaises(AssertionError,
             self.test_data_ranges.__add__, self.test_string)
@@ -494,18 +2097,18 @@ class TestSasData(unittest.TestCase):
 
         # test simple multiplication
         test_mul = self.test_data_ranges * 2
-        self.assertEqual(self.eighteen_to_zero, test_mul.i)
-        self.assertEqual(self.zero_to_nine, test_mul.q)
+        self.assertEqual(self.eighteen_to_zero, test_mul.i.tolist())
+        self.assertEqual(self.zero_to_nine, test_mul.q.tolist())
 
         # test multiplication by zero
         test_mul = self.test_data_ranges * 0
-        self.assertEqual([0] * len(self.test_data_ranges), test_mul.i)
-        self.assertEqual(self.zero_to_nine, test_mul.q)
+        self.assertEqual([0] * len(self.test_data_ranges), test_mul.i.tolist())
+        self.assertEqual(self.zero_to_nine, test_mul.q.tolist())
 
         # test multiplication by a float
         test_mul = self.test_data_ranges * 0.25
-        self.assertEqual(self.test_floats, test_mul.i)
-        self.assertEqual(self.zero_to_nine, test_mul.q)
+        self.assertEqual(self.test_floats, test_mul.i.tolist())
+        self.assertEqual(self.zero_to_nine, test_mul.q.tolist())
 
     def test_masking(self):
         """Tests for make_mask and mask."""
@@ -518,13 +2121,13 @@ class TestSasData(unittest.TestCase):
                 (arange(4,1, -0.001)))
 
         test_data.make_mask(test_mask_1)
-        self.assertTrue(test_data.mask != None)
+        self.assertTrue(test_data.mask is not None)
         self.assertEqual(len(test_data.q), len(test_data.mask))
         self.assertEqual(test_data.mask[0], 0)
         self.assertEqual(test_data.mask[-1], 1)
 
         test_data.make_mask(test_mask_2)
-        self.assertTrue(test_data.mask != None)
+        self.assertTrue(test_data.mask is not None)
         self.assertEqual(len(test_data.q), len(test_data.mask))
         self.assertEqual(test_data.mask[0], 1)
         self.assertEqual(test_data.mask[-1], 1)
@@ -537,7 +2140,182 @@ class TestSasData(unittest.TestCase):
         self.assertRaises(AssertionError, test_data.apply_mask,)
 
         test_data.make_mask(test_mask_1)
-        test_data.mask
+        self.assertEqual(test_data.mask.dtype, bool)
+        masked = test_data.apply_mask()
+        self.assertFalse(((masked.q >= 0.05) & (masked.q <= 0.1)).any())
+        self.assertEqual(len(masked), test_data.mask.sum())
+
+        # masks given as lists of 0's and 1's still work
+        test_data.mask = test_data.mask.astype(int).tolist()
+        self.assertTrue(allclose(test_data.apply_mask().q, masked.q))
+
+        self.assertRaises(AssertionError, test_data.make_mask, [0., 1.])
+
+    def test_wrap_array(self):
+        """Tests for wrap_array and data_columns."""
+
+        data = column_stack((arange(0, 3, 0.001), arange(4, 1, -0.001)))
+        test_data = wrap_array(data)
+        self.assertTrue(isinstance(test_data, ExpSasData))
+        self.assertTrue(may_share_memory(test_data.q, data))
+        self.assertTrue(may_share_memory(test_data.i, data))
+        self.assertEqual(test_data.idev, None)
+        self.assertTrue(data.flags.writeable)
+
+        # i is a view so changes show up in the original array
+        test_data.i[0] = -1.
+        self.assertEqual(data[0,1], -1.)
+
+        # a third column is taken as idev
+        data = column_stack((data, ones(len(data))))
+        test_data = wrap_array(data)
+        self.assertTrue(may_share_memory(test_data.idev, data))
+        self.assertTrue(allclose(test_data.idev, 1.))
+        test_data.make_mask([[1., 2.]])
+        self.assertEqual(len(test_data.apply_mask().idev),
+                         test_data.mask.sum())
+
+        # arrays and SasData objects give the same columns, uncopied
+        q, i, idev = data_columns(data)
+        self.assertTrue(may_share_memory(q, data))
+        self.assertTrue(allclose(idev, 1.))
+        q, i, idev = data_columns(test_data)
+        self.assertTrue(q is test_data.q and i is test_data.i)
+        self.assertTrue(idev is test_data.idev)
+        self.assertEqual(data_columns(SasData(q, i))[2], None)
+
+        self.assertTrue(wrap_array(data, float32).i.dtype == float32)
+
+        # integer arrays are converted so arithmetic is not truncated
+        integers = array([[1, 10], [2, 11], [3, 12]])
+        test_data = wrap_array(integers)
+        self.assertEqual(test_data.i.dtype, float64)
+        self.assertTrue(allclose((test_data * 0.5).i, [5., 5.5, 6.]))
+        self.assertTrue(allclose((test_data + 0.7).i, [10.7, 11.7, 12.7]))
+        self.assertRaises(AssertionError, wrap_array, data[:,0])
+        self.assertRaises(AssertionError, data_columns, ones((10, 4)))
+
+    def test_sastrim(self):
+        """Tests that the legacy sastrim takes arrays and SasData objects."""
+
+        import subprocess
+        import sys
+        import sastrim
+
+        # only numpy, not sas and the plotting modules, is imported
+        imported = subprocess.check_output(
+                [sys.executable, '-c', 'import sys, sastrim; '
+                 'print "sas" in sys.modules, "matplotlib" in sys.modules'],
+                cwd=os.path.dirname(os.path.abspath(__file__)))
+        self.assertEqual(imported.split(), ['False', 'False'])
+
+        data = column_stack((arange(0.01, 1, 0.01), arange(99, 0, -1.),
+                             ones(99)))
+        ranges = [[0.1, 0.2], [0.5, 0.6]]
+        mask = sastrim.generate_mask(data, ranges)
+        self.assertEqual(mask.dtype, bool)
+        self.assertTrue(array_equal(mask, range_mask(data[:,0], ranges)))
+
+        masked = sastrim.mask_data(data, mask)
+        self.assertEqual(masked.shape, (mask.sum(), 3))
+        self.assertTrue(array_equal(masked, data[mask]))
+        masked = sastrim.mask_data(data[:,:2], mask)
+        self.assertEqual(masked.shape, (mask.sum(), 2))
+
+        # SasData objects give the same mask and come back as objects
+        test_data = wrap_array(data)
+        self.assertTrue(array_equal(sastrim.generate_mask(test_data, ranges),
+                                    mask))
+        masked = sastrim.mask_data(test_data, mask)
+        self.assertTrue(isinstance(masked, ExpSasData))
+        self.assertTrue(array_equal(masked.q, data[mask, 0]))
+        self.assertTrue(array_equal(masked.idev, data[mask, 2]))
+
+        masked = sastrim.mask_data(SasData(data[:,0], data[:,1]), mask)
+        self.assertTrue(isinstance(masked, SasData))
+        self.assertTrue(array_equal(masked.i, data[mask, 1]))
+        self.assertFalse(hasattr(masked, 'idev'))
+
+        # ExpSasData objects keep qdev and are smeared on the full grid,
+        # as with apply_mask, and their own mask is left alone
+        test_data = ExpSasData(data[:,0], data[:,1], data[:,2],
+                               qdev=0.05 * data[:,0])
+        masked = sastrim.mask_data(test_data, mask)
+        self.assertTrue(array_equal(masked.qdev, test_data.qdev[mask]))
+        self.assertTrue(masked.model_q is test_data.q)
+        self.assertEqual(masked.resolution().shape,
+                         (mask.sum(), len(test_data)))
+        self.assertEqual(test_data.mask, None)
+
+    def test_storage(self):
+        """Tests for the compact storage of SasData objects."""
+
+        test_data = ExpSasData(arange(0, 3, 0.001), arange(4, 1, -0.001))
+        self.assertFalse(hasattr(test_data, '__dict__'))
+        self.assertEqual(test_data.i.dtype, float64)
+        self.assertTrue(test_data.i.flags.c_contiguous)
+        self.assertFalse(test_data.q.flags.writeable)
+
+        # derived objects share q rather than copying it
+        self.assertTrue((test_data + test_data).q is test_data.q)
+        self.assertTrue((test_data * 2.).q is test_data.q)
+        self.assertTrue((test_data + 1).q is test_data.q)
+
+        # a writeable array passed in is copied and stays writeable
+        q = arange(0, 3, 0.001)
+        test_data = SasData(q, q)
+        self.assertTrue(q.flags.writeable)
+        self.assertRaises(ValueError, test_data.q.__setitem__, 0, 1.)
+        self.assertFalse(may_share_memory(test_data.q, q))
+        test_data.i[0] = 99.
+        q[1] = 99.
+        self.assertEqual(test_data.q[:2].tolist(), [0., 0.001])
+
+        q = arange(0, 3, 0.001)
+        test_data = ExpSasData(q, q, q, q, dtype=float32)
+        for values in [test_data.q, test_data.i, test_data.idev,
+                       test_data.qdev, (test_data * 2.).i]:
+            self.assertEqual(values.dtype, float32)
+        test_data.make_mask([[1., 2.]])
+        self.assertEqual(test_data.apply_mask().i.dtype, float32)
+
+    def test_pickle(self):
+        """Tests for pickling SasData objects with every protocol."""
+
+        q = arange(0.005, 0.2, 0.001)
+        test_data = ExpSasData(q, q * 2, q * 0.1, q * 0.05)
+        test_data.make_mask([[0.05, 0.1]])
+        test_data.apply_mask()
+
+        for protocol in range(pickle.HIGHEST_PROTOCOL + 1):
+            test = pickle.loads(pickle.dumps(test_data, protocol))
+            self.assertTrue(isinstance(test, ExpSasData))
+            for name in ['q', 'i', 'idev', 'qdev', 'mask']:
+                self.assertTrue(array_equal(getattr(test, name),
+                                            getattr(test_data, name)))
+            self.assertFalse(test.q.flags.writeable)
+            self.assertTrue(allclose(test.masked.i, test_data.masked.i))
+            self.assertTrue(test.masked.model_q is test.q)
+            self.assertEqual(test.masked.resolution().shape,
+                             test_data.masked.resolution().shape)
+
+            test = pickle.loads(pickle.dumps(SasData([1., 2.], [3., 4.]),
+                                             protocol))
+            self.assertEqual(test.i.tolist(), [3., 4.])
+
+    def test_resolution_cache(self):
+        """Tests the smearing matrix is rebuilt if q changes in place."""
+
+        data = column_stack((arange(0.005, 0.2, 0.001),
+                             ones(195))).copy()
+        test_data = wrap_array(data)
+        test_data.qdev = 0.05 * test_data.q + 0.002
+        first = test_data.resolution()
+        self.assertTrue(test_data.resolution() is first)
+
+        # the q column of a wrapped array can still be changed
+        data[:,0] *= 2.
+        self.assertFalse(test_data.resolution() is first)
 
 
 class TestAnalysis(unittest.TestCase):
@@ -584,6 +2362,596 @@ class TestAnalysis(unittest.TestCase):
         self.assertEqual(test_outs[0][1],Rg)
         self.assertEqual(test_outs[0][2], background)
 
+    def test_smearing(self):
+        """Tests for smearing_matrix and smeared fitting."""
+
+        q = arange(0.005, 0.2, 0.001)
+        qdev = 0.05 * q + 0.002
+        test_params = [100., 20., 1.]
+
+        resolution = smearing_matrix(q, qdev)
+        self.assertEqual(resolution.shape, (len(q), len(q)))
+        self.assertTrue(allclose(resolution.sum(axis=1), 1.))
+        self.assertTrue(resolution.nnz < len(q)**2 / 2)
+
+        # zero resolution leaves the model alone
+        flat = smearing_matrix(q, zeros(len(q)))
+        self.assertTrue(allclose(flat.toarray(), identity(len(q))))
+
+        self.assertRaises(AssertionError, smearing_matrix, q[::-1], qdev)
+
+        # the matrix is only built once per dataset
+        test_data = ExpSasData(q, resolution.dot(guinier(q, test_params)),
+                               qdev=qdev)
+        self.assertTrue(test_data.resolution() is test_data.resolution())
+        self.assertEqual(ExpSasData(q, q, qdev=zeros(len(q))).resolution(),
+                         None)
+
+        # smeared fit recovers the parameters, an unsmeared one does not
+        test_outs = fit_guinier(test_data)
+        self.assertTrue(allclose(test_outs[0], test_params, rtol=1e-4))
+        test_outs = fit_guinier(test_data, smear=False)
+        self.assertFalse(allclose(test_outs[0], test_params, rtol=1e-4))
+
+        # uncertainties come through the mask
+        test_data.make_mask([[0.1, 0.15]])
+        masked = test_data.apply_mask()
+        self.assertEqual(len(masked.qdev), len(masked))
+        self.assertTrue(masked.resolution() is not None)
+
+    def test_masked_smearing(self):
+        """Tests that masked data is smeared on the full q grid."""
+
+        q = arange(0.005, 0.2, 0.001)
+        qdev = 0.05 * q + 0.002
+        test_params = [100., 20., 1.]
+        resolution = smearing_matrix(q, qdev)
+        test_data = ExpSasData(q, resolution.dot(guinier(q, test_params)),
+                               qdev=qdev)
+
+        test_data.make_mask([[0.03, 0.06]])
+        masked = test_data.apply_mask()
+        self.assertTrue(masked.model_q is test_data.q)
+        self.assertEqual(masked.resolution().shape, (len(masked), len(q)))
+        test_outs = fit_guinier(masked)
+        self.assertTrue(allclose(abs(test_outs[0]), test_params, rtol=1e-6))
+
+        # masking the masked data again still uses the full grid
+        masked.make_mask([[0.15, 0.2]])
+        twice = masked.apply_mask()
+        self.assertTrue(twice.model_q is test_data.q)
+        self.assertTrue(allclose(abs(fit_guinier(twice)[0]), test_params,
+                                 rtol=1e-6))
+        best = bootstrap_guinier(twice, 20, seed=1)[0]
+        self.assertTrue(allclose(abs(best), test_params, rtol=1e-6))
+
+    def test_smearing_thinning(self):
+        """Tests thinning of the bands of finely sampled smearing matrices."""
+
+        q = linspace(0.005, 0.2, 4000)
+        qdev = 0.05 * q + 0.002
+        whole = smearing_matrix(q, qdev, max_points=None)
+        thinned = smearing_matrix(q, qdev)
+        self.assertTrue(diff(thinned.indptr).max() <= 25)
+        self.assertTrue(thinned.nnz * 10 < whole.nnz)
+        self.assertTrue(allclose(thinned.sum(axis=1), 1.))
+
+        # no worse than cutting the Gaussian off, compared to a wider one
+        wide = smearing_matrix(q, qdev, cutoff=6., max_points=None)
+        model = guinier(q, [100., 20., 1.])
+        error = abs(thinned.dot(model) / wide.dot(model) - 1.).max()
+        cut_off = abs(whole.dot(model) / wide.dot(model) - 1.).max()
+        self.assertTrue(error < 1.5 * cut_off)
+
+        # narrow bands are used whole
+        narrow = smearing_matrix(q, 0.0005 * q)
+        self.assertTrue(allclose(narrow.toarray(), smearing_matrix(
+                q, 0.0005 * q, max_points=None).toarray()))
+
+
+    def test_batch_fit(self):
+        """Tests for fit_model_batch against leastsq."""
+
+        q = arange(0.005, 0.1, 0.001)
+        test_params = array([[100., 20., 1.], [50., 30., 0.], [10., 10., 5.]])
+        i_stack = evaluate_model_batch(guinier, q, test_params)
+        i_stack += RandomState(0).normal(0, 0.5, i_stack.shape)
+
+        batch, converged = fit_model_batch(i_stack, q, guinier,
+                                           [80., 15., 0.5])
+        self.assertEqual(batch.shape, test_params.shape)
+        self.assertTrue(converged.all())
+        for j in range(len(i_stack)):
+            single = fit_model(SasData(q, i_stack[j]), guinier,
+                               [80., 15., 0.5])[0]
+            self.assertTrue(allclose(batch[j], single, rtol=1e-4))
+
+        # a curve with a NaN in it is reported as not converged
+        i_stack[1, 10] = nan
+        batch, converged = fit_model_batch(i_stack, q, guinier,
+                                           [80., 15., 0.5])
+        self.assertEqual(converged.tolist(), [True, False, True])
+
+        # as is one which runs out of iterations
+        batch, converged = fit_model_batch(i_stack, q, guinier,
+                                           [80., 15., 0.5], max_iterations=1)
+        self.assertFalse(converged.any())
+
+    def test_bootstrap(self):
+        """Tests for bootstrap_fit and bootstrap_guinier."""
+
+        q = arange(0.01, 0.5, 0.005)
+        test_params = [10., 5., 1.]
+        noise = RandomState(1).normal(0, 0.1, len(q))
+        test_data = ExpSasData(q, guinier(q, test_params) + noise,
+                               idev=ones(len(q)) * 0.1)
+
+        for method in ['residual', 'monte_carlo']:
+            best, error, interval, samples = bootstrap_guinier(
+                    test_data, 200, method, seed=2)
+            self.assertEqual(samples.shape, (200, 3))
+            self.assertEqual(interval.shape, (2, 3))
+            self.assertTrue((error > 0).all())
+            self.assertTrue((interval[0] < best).all())
+            self.assertTrue((interval[1] > best).all())
+            self.assertTrue(abs(abs(best[1]) - 5.) < 4 * error[1])
+
+        # splitting across processes gives the same answer
+        pooled = bootstrap_guinier(test_data, 200, seed=2, processes=2)
+        single = bootstrap_guinier(test_data, 200, seed=2)
+        self.assertTrue(allclose(pooled[3], single[3]))
+
+        self.assertRaises(AssertionError, bootstrap_guinier,
+                          SasData(q, test_data.i), 10, 'monte_carlo')
+
+        # failed fits are left out with a warning
+        test_data.idev[5] = nan
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            self.assertRaises(AssertionError, bootstrap_guinier, test_data,
+                              10, 'monte_carlo')
+        self.assertEqual(len(caught), 1)
+        self.assertTrue('10 of 10' in str(caught[0].message))
+
+
+class TestMerging(unittest.TestCase):
+
+    def setUp(self):
+        self.q_true = arange(0.01, 1., 0.001)
+        self.i_true = 100. * exp(-(5. * self.q_true)**2) + 1.
+        self.ranges = [(0.01, 0.2), (0.15, 0.6), (0.5, 1.)]
+
+    def make_curve(self, q_range, scale, offset, idev=True):
+        q = arange(q_range[0], q_range[1], 0.0013)
+        i = (interp(q, self.q_true, self.i_true) - offset) / scale
+        errors = None
+        if idev:
+            errors = 0.01 * i + 0.01
+        return ExpSasData(q, i, errors)
+
+    def test_merge_curves(self):
+        """Tests for merge_curves."""
+
+        curves = [self.make_curve(self.ranges[0], 1., 0.),
+                  self.make_curve(self.ranges[1], 2., 0.),
+                  self.make_curve(self.ranges[2], 0.5, 0.)]
+        merged, scales, offsets = merge_curves(curves)
+        self.assertTrue(allclose(scales, [1., 2., 0.5], rtol=1e-3))
+        self.assertTrue(allclose(offsets, 0.))
+        self.assertTrue(allclose(merged.i, interp(merged.q, self.q_true,
+                                                  self.i_true), rtol=1e-3))
+        self.assertEqual(len(merged.idev), len(merged))
+
+        # offsets as well, and curves given out of order
+        curves = [self.make_curve(self.ranges[2], 0.5, 0.2, False),
+                  self.make_curve(self.ranges[0], 1., 0., False),
+                  self.make_curve(self.ranges[1], 2., 0.1, False)]
+        merged, scales, offsets = merge_curves(curves, offset=True,
+                                               reference=1)
+        self.assertTrue(allclose(scales, [0.5, 1., 2.], rtol=1e-3))
+        self.assertTrue(allclose(offsets, [0.2, 0., 0.1], atol=1e-3))
+        self.assertEqual(merged.idev, None)
+
+        # scaling onto a different reference
+        merged, scales, offsets = merge_curves(curves, reference=2)
+        self.assertTrue(allclose(scales[2], 1.))
+
+        curves = [self.make_curve((0.01, 0.1), 1., 0.),
+                  self.make_curve((0.2, 0.3), 1., 0.)]
+        self.assertRaises(AssertionError, merge_curves, curves)
+
+    def test_merge_collections(self):
+        """Tests for merging many paired runs at once."""
+
+        run_scales = [1., 3., 0.2, 7.]
+        collections = [[self.make_curve(q_range, scale * k, 0.)
+                        for scale in run_scales]
+                       for k, q_range in zip([1., 2., 4.], self.ranges)]
+
+        merged, scales, offsets = merge_collections(collections)
+        self.assertEqual(len(merged), len(run_scales))
+        self.assertEqual(scales.shape, (len(run_scales), 3))
+        for j in range(len(run_scales)):
+            self.assertTrue(allclose(scales[j], [1., 2., 4.], rtol=1e-3))
+            single = merge_curves([collection[j]
+                                   for collection in collections])[0]
+            self.assertTrue(allclose(merged[j].i, single.i))
+            self.assertTrue(merged[j].q is merged[0].q)
+
+        self.assertRaises(AssertionError, merge_collections,
+                          [collections[0], collections[1][:2]])
+
+    def test_merged_errors(self):
+        """Tests that merged errors match the scatter in the overlap."""
+
+        random_state = RandomState(7)
+        collections = []
+        for q_range, scale in zip(self.ranges[:2], [1., 2.]):
+            collection = []
+            for run in range(200):
+                data = self.make_curve(q_range, scale, 0.)
+                noisy = data.i + data.idev * random_state.standard_normal(
+                        len(data))
+                collection.append(ExpSasData(data.q, noisy, data.idev))
+            collections.append(collection)
+
+        # pulls should have unit spread, as the errors are not shrunk
+        # by counting the same measurement at several grid points
+        q_grids = [None, arange(0.1505, 0.1995, 0.001)]
+        for q_grid in q_grids:
+            merged, scales, offsets = merge_collections(collections,
+                                                        q_grid=q_grid)
+            q = merged[0].q
+            overlap = (q >= 0.15) & (q <= 0.2)
+            truth = interp(q, self.q_true, self.i_true)
+            pulls = array([(data.i - truth) / data.idev
+                           for data in merged])[:, overlap]
+            self.assertTrue(0.95 < pulls.std() < 1.05)
+            self.assertTrue(abs(pulls.mean()) < 0.1)
+        self.assertTrue(allclose(scales.mean(axis=0), [1., 2.], rtol=1e-2))
+
+        # measured points keep their own errors, scaled
+        merged, scales, offsets = merge_curves([collections[0][0],
+                                                collections[1][0]])
+        above = collections[1][0].q > 0.2
+        self.assertTrue(allclose(merged.idev[merged.q > 0.2],
+                                 collections[1][0].idev[above] * scales[1]))
+
+
+class TestComponents(unittest.TestCase):
+
+    def setUp(self):
+        self.q = arange(0.01, 0.5, 0.002)
+        basis = array([exp(-(5. * self.q)**2), exp(-(10. * self.q)**2),
+                       1. / (1. + (20. * self.q)**2)])
+        random_state = RandomState(3)
+        amounts = random_state.uniform(0., 1., (60, 3))
+        self.stack = dot(amounts, basis)
+        self.stack += random_state.normal(0., 1e-6, self.stack.shape)
+        self.curves = [SasData(self.q, row) for row in self.stack]
+
+    def test_svd_curves(self):
+        """Tests for the svd solvers agreeing with each other."""
+
+        q, u, s, vt = svd_curves(self.curves)
+        self.assertEqual(len(s), len(self.curves))
+        self.assertTrue(s[2] / s[0] > 1e-3)
+        self.assertTrue(s[3] / s[0] < 1e-4)
+
+        for method in ['truncated', 'randomized', 'blocked']:
+            q_k, u_k, s_k, vt_k = svd_curves(self.curves, 3, method,
+                                             block_size=7, seed=4)
+            self.assertEqual(u_k.shape, (len(self.curves), 3))
+            self.assertEqual(vt_k.shape, (3, len(self.q)))
+            self.assertTrue(allclose(s_k, s[:3], rtol=1e-6))
+            rebuilt = reconstruct_curve(q_k, u_k, s_k, vt_k, 5)
+            self.assertTrue(allclose(rebuilt.i, self.stack[5], atol=1e-5))
+
+        self.assertRaises(AssertionError, svd_curves, self.curves, None,
+                          'randomized')
+        self.assertRaises(AssertionError, stack_curves,
+                          [self.curves[0], SasData(self.q * 2, self.q)])
+
+    def test_masked_and_blocked(self):
+        """Tests for masking and out of memory stacks."""
+
+        mask_ranges = [[0., 0.05], [0.3, 0.35]]
+        q, u, s, vt = svd_curves(self.curves, 3, mask_ranges=mask_ranges)
+        self.assertEqual(len(q), range_mask(self.q, mask_ranges).sum())
+        self.assertEqual(vt.shape[1], len(q))
+
+        test_dir = tempfile.mkdtemp()
+        try:
+            path = os.path.join(test_dir, 'stack.dat')
+            stack = memmap(path, float64, 'w+', shape=self.stack.shape)
+            stack[:] = self.stack
+            stack.flush()
+            stack = memmap(path, float64, 'r', shape=self.stack.shape)
+
+            q_b, u_b, s_b, vt_b = svd_stack(self.q, stack, 3, 'blocked',
+                                            mask_ranges, block_size=16)
+            self.assertTrue(allclose(s_b, s, rtol=1e-6))
+
+            residuals, explained = svd_residuals(
+                    self.q, stack, u_b, s_b, vt_b, mask_ranges, 16)
+            self.assertEqual(len(residuals), len(self.curves))
+            self.assertTrue((residuals < 1e-4).all())
+            self.assertTrue(allclose(explained[-1], 1.))
+            self.assertTrue((diff(explained) >= 0).all())
+
+            # one component leaves a lot unexplained
+            residuals, explained = svd_residuals(
+                    self.q, stack, u_b[:, :1], s_b[:1], vt_b[:1],
+                    mask_ranges, 16)
+            self.assertTrue(residuals.max() > 1e-2)
+            self.assertTrue(explained[0] < 1.)
+
+            # without a mask the blocks are the stack's own rows, which
+            # are read-only here and must not be changed in any case
+            q_b, u_b, s_b, vt_b = svd_stack(self.q, stack, 3, 'blocked',
+                                            block_size=16)
+            residuals, explained = svd_residuals(self.q, stack, u_b, s_b,
+                                                 vt_b, block_size=16)
+            self.assertTrue((residuals < 1e-4).all())
+            self.assertTrue(array_equal(stack, self.stack))
+            del stack
+        finally:
+            shutil.rmtree(test_dir)
+
+        stack = self.stack.copy()
+        q, u, s, vt = svd_stack(self.q, stack, 3)
+        residuals, explained = svd_residuals(self.q, stack, u, s, vt)
+        self.assertTrue((residuals < 1e-4).all())
+        self.assertTrue(allclose(explained[-1], 1.))
+        self.assertTrue(array_equal(stack, self.stack))
+
+
+class TestFitCache(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.test_dir, 'cache.db')
+        q = arange(0.01, 0.5, 0.005)
+        self.test_data = ExpSasData(q, guinier(q, [10., 5., 1.]))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_cache(self):
+        """Tests for FitCache hits and misses."""
+
+        cache = FitCache(self.path)
+        first = cache.fit_guinier(self.test_data)
+        self.assertEqual((cache.hits, cache.misses), (0, 1))
+        self.assertTrue(allclose(first[0], fit_guinier(self.test_data)[0]))
+
+        # same fit again, from this cache and from a new one on the file
+        self.assertTrue(allclose(cache.fit_guinier(self.test_data)[0],
+                                 first[0]))
+        other = FitCache(self.path)
+        other.fit_guinier(self.test_data)
+        self.assertEqual((cache.hits, other.hits), (1, 1))
+
+        # anything changing the fit misses
+        changed = ExpSasData(self.test_data.q, self.test_data.i * 2)
+        cache.fit_guinier(changed)
+        self.test_data.make_mask([[0.1, 0.2]])
+        cache.fit_guinier(self.test_data)
+        cache.fit_guinier(self.test_data, False)
+        cache.call(fit_model, self.test_data, guinier, [9., 4., 0.])
+        self.assertEqual(cache.misses, 5)
+        cache.call(fit_model, self.test_data, guinier, [9., 4., 0.])
+        self.assertEqual(cache.hits, 2)
+
+        cache.clear()
+        cache.fit_guinier(changed)
+        self.assertEqual(cache.misses, 6)
+
+    def test_model_keys(self):
+        """Tests that models differing only outside their bytecode miss."""
+
+        cache = FitCache(self.path)
+        models = [lambda q, p: p[0] * exp(-p[1] * q),
+                  lambda q, p: p[0] * cos(-p[1] * q),
+                  lambda q, p, power=1.: p[0] * exp(-p[1] * q**power),
+                  lambda q, p, power=2.: p[0] * exp(-p[1] * q**power)]
+
+        def scaled_model(scale):
+            return lambda q, p: scale * p[0] * exp(-p[1] * q)
+        models += [scaled_model(1.), scaled_model(2.)]
+
+        keys = [cache.key(fit_model, self.test_data, model, [1., 1.])
+                for model in models]
+        self.assertEqual(len(set(keys)), len(models))
+        self.assertEqual(keys[-1], cache.key(
+                fit_model, self.test_data, scaled_model(2.), [1., 1.]))
+
+    def test_object_keys(self):
+        """Tests that model objects are keyed by content, not address."""
+
+        class Model(object):
+            def __init__(self, scale):
+                self.scale = scale
+
+            def __call__(self, q, p):
+                return self.scale * p[0] * exp(-p[1] * q)
+
+            def model(self, q, p):
+                return self(q, p)
+
+        def scaled(q, p, scale=1.):
+            return scale * p[0] * exp(-p[1] * q)
+
+        cache = FitCache(self.path)
+        pairs = [(Model(1.), Model(2.)),
+                 (Model(1.).model, Model(2.).model),
+                 (functools.partial(scaled, scale=1.),
+                  functools.partial(scaled, scale=2.))]
+        for first, second in pairs:
+            key = cache.key(fit_model, self.test_data, first, [1., 1.])
+            self.assertNotEqual(key, cache.key(fit_model, self.test_data,
+                                               second, [1., 1.]))
+        self.assertEqual(cache.key(fit_model, self.test_data, Model(2.)),
+                         cache.key(fit_model, self.test_data, Model(2.)))
+
+        # objects only told apart by address are not cached
+        import threading
+        model = Model(1.)
+        model.lock = threading.Lock()
+        self.assertRaises(TypeError, cache.key, fit_model, self.test_data,
+                          model, [1., 1.])
+        with warnings.catch_warnings(record=True) as caught:
+            warnings.simplefilter('always')
+            param = cache.call(fit_model, self.test_data, model,
+                               [10., 0.1])[0]
+        self.assertEqual(len(caught), 1)
+        self.assertEqual((cache.hits, cache.misses), (0, 0))
+        self.assertEqual(len(param), 2)
+
+    def test_global_keys(self):
+        """Tests that changing a global or helper used by a model misses."""
+
+        source = '''
+POWER = 2.
+
+def helper(q, p):
+    return p[0] * exp(-p[1] * q**POWER)
+
+def model(q, p):
+    return helper(q, p) + p[2]
+'''
+        namespace = {'exp': exp}
+        exec source in namespace
+        cache = FitCache(self.path)
+
+        def key():
+            return cache.key(fit_model, self.test_data, namespace['model'],
+                             [1., 1., 0.])
+        first = key()
+
+        namespace['POWER'] = 3.
+        self.assertNotEqual(key(), first)
+        namespace['POWER'] = 2.
+        self.assertEqual(key(), first)
+
+        exec source.replace('p[1] * q', 'p[1] * 2 * q') in namespace
+        self.assertNotEqual(key(), first)
+
+    def test_eviction(self):
+        """Tests that the least recently used results are removed."""
+
+        size = len(pickle.dumps(fit_guinier(self.test_data),
+                                pickle.HIGHEST_PROTOCOL))
+        cache = FitCache(self.path, max_size=int(2.5 * size))
+
+        frames = [self.test_data * scale for scale in [1., 2., 3.]]
+        cache.fit_guinier(frames[0])
+        cache.fit_guinier(frames[1])
+        cache.fit_guinier(frames[0])
+        cache.fit_guinier(frames[2])
+        self.assertEqual((cache.hits, cache.misses), (1, 3))
+
+        # frames[1] was least recently used so it has gone
+        cache.fit_guinier(frames[0])
+        cache.fit_guinier(frames[2])
+        self.assertEqual(cache.hits, 3)
+        cache.fit_guinier(frames[1])
+        self.assertEqual(cache.misses, 4)
+
+
+class TestMaskEditor(unittest.TestCase):
+
+    def setUp(self):
+        q = linspace(0.01, 0.5, 50000)
+        self.test_data = ExpSasData(q, guinier(q, [10., 5., 1.]))
+        self.test_data.i[(q > 0.2) & (q < 0.25)] += 3.
+        from matplotlib.backends.backend_agg import FigureCanvasAgg
+        self.figure = fig.Figure()
+        FigureCanvasAgg(self.figure)
+
+    def send(self, name, q, button=1):
+        """Sends a mouse event at q in the middle of the plot."""
+
+        from matplotlib.backend_bases import MouseEvent
+        axes = self.editor.axes
+        x, y = axes.transData.transform((q, mean(axes.get_ylim())))
+        event = MouseEvent(name, self.figure.canvas, x, y, button)
+        self.figure.canvas.callbacks.process(name, event)
+
+    def drag(self, low, high, button=1):
+        self.send('button_press_event', low, button)
+        self.send('motion_notify_event', (low + high) / 2., button)
+        self.send('button_release_event', high, button)
+
+    def test_mask_editor(self):
+        """Tests for masking and refitting by simulated mouse events."""
+
+        self.editor = MaskEditor(self.test_data, figure=self.figure)
+        self.assertTrue(self.test_data.mask.all())
+        self.assertTrue(self.editor.background is not None)
+        self.assertFalse(allclose(self.editor.param, [10., 5., 1.],
+                                  rtol=1e-3))
+
+        # masking the bump gives back the right parameters
+        self.drag(0.19, 0.26)
+        self.assertEqual(len(self.editor.mask_ranges()), 1)
+        low, high = self.editor.mask_ranges()[0]
+        self.assertTrue(abs(low - 0.19) < 1e-3 and abs(high - 0.26) < 1e-3)
+        self.assertTrue(allclose(abs(self.editor.param), [10., 5., 1.],
+                                 rtol=1e-6))
+        masked = self.test_data.apply_mask()
+        self.assertFalse(((masked.q > 0.2) & (masked.q < 0.25)).any())
+        self.assertTrue(isnan(self.editor.kept_line.get_ydata()[
+                self.test_data.q.searchsorted(0.22)]))
+        self.assertTrue(self.editor.update_time < 1.)
+
+        # unmasking part of the range with the right button splits it
+        self.drag(0.21, 0.22, 3)
+        self.assertEqual(len(self.editor.mask_ranges()), 2)
+        self.assertFalse(allclose(abs(self.editor.param), [10., 5., 1.],
+                                  rtol=1e-6))
+
+        # 'r' is left to matplotlib, 'u' clears the mask
+        from matplotlib.backend_bases import KeyEvent
+        self.assertTrue('u' not in rcParams['keymap.home'])
+        for key in ['r', 'u']:
+            event = KeyEvent('key_press_event', self.figure.canvas, key)
+            self.figure.canvas.callbacks.process('key_press_event', event)
+            self.assertEqual(self.test_data.mask.all(), key == 'u')
+        self.assertEqual(self.editor.mask_ranges(), [])
+
+        self.editor.disconnect()
+        self.drag(0.19, 0.26)
+        self.assertTrue(self.test_data.mask.all())
+
+    def test_smeared_editor(self):
+        """Tests that the editor fits with resolution smearing."""
+
+        q = arange(0.005, 0.2, 0.001)
+        qdev = 0.05 * q + 0.002
+        i = smearing_matrix(q, qdev).dot(guinier(q, [100., 20., 1.]))
+        test_data = ExpSasData(q, i, qdev=qdev)
+        test_data.make_mask([[0.1, 0.15]])
+
+        self.editor = MaskEditor(test_data, param_0=[90., 18., 0.],
+                                 figure=self.figure)
+        self.assertTrue(allclose(abs(self.editor.param), [100., 20., 1.],
+                                 rtol=1e-4))
+        self.assertEqual(len(self.editor.mask_ranges()), 1)
+
+        # broad resolution on many points uses a thinned matrix
+        q = self.test_data.q
+        test_data = ExpSasData(q, self.test_data.i, qdev=0.02 * q + 0.0005)
+        self.editor = MaskEditor(test_data, param_0=[10., 5., 1.],
+                                 figure=self.figure)
+        self.assertTrue(self.editor.resolution is test_data.resolution())
+        self.drag(0.19, 0.26)
+        self.assertEqual(len(self.editor.mask_ranges()), 1)
+        self.assertTrue(allclose(abs(self.editor.param), [10., 5., 1.],
+                                 rtol=1e-2))
+        self.assertTrue(self.editor.update_time < 1.)
+
+
 class TestLoaders(unittest.TestCase):
 
     def test_i22_loader(self):
@@ -615,6 +2983,112 @@ class TestLoaders(unittest.TestCase):
         # need to write a test once the loader is set up to
         # catch an incorrect file type
 
+
+class TestWriters(unittest.TestCase):
+
+    def setUp(self):
+        self.test_dir = tempfile.mkdtemp()
+        self.test_data = ExpSasData(arange(0.01, 0.5, 0.001),
+                                    arange(10, 0.2, -0.02),
+                                    arange(0.1, 0.002, -0.0002),
+                                    arange(0.001, 0.05, 0.0001))
+
+    def tearDown(self):
+        shutil.rmtree(self.test_dir)
+
+    def test_two_column_writer(self):
+        """Round trip tests for save_two_column_data."""
+
+        for name in ['test.dat', 'test.dat.gz']:
+            path = os.path.join(self.test_dir, name)
+            save_two_column_data(self.test_data, path,
+                                 header=['line one', 'line two', 'line three'])
+            test = load_two_column_data(path, 3)
+            self.assertTrue(allclose(test.q, self.test_data.q))
+            self.assertTrue(allclose(test.i, self.test_data.i))
+
+        # gzip is detected from the file contents not the name
+        path = os.path.join(self.test_dir, 'compressed.dat')
+        save_two_column_data(self.test_data, path, compress=True)
+        self.assertEqual(open(path, 'rb').read(2), '\x1f\x8b')
+        test = load_two_column_data(path)
+        self.assertTrue(allclose(test.i, self.test_data.i))
+
+    def test_sasxml_writer(self):
+        """Round trip tests for savesasxml."""
+
+        path = os.path.join(self.test_dir, 'test.xml')
+        savesasxml(self.test_data, path)
+        test = loadsasxml(path)
+        self.assertTrue(allclose(test.q, self.test_data.q))
+        self.assertTrue(allclose(test.i, self.test_data.i))
+        self.assertTrue(allclose(test.idev, self.test_data.idev))
+        self.assertTrue(allclose(test.qdev, self.test_data.qdev))
+
+        # several entries in one compressed file
+        second = SasData(self.test_data.q, self.test_data.i * 2)
+        path = os.path.join(self.test_dir, 'test.xml.gz')
+        savesasxml([self.test_data, second], path, names=['first', 'sec<2>'])
+        test = loadsasxml(path, 1)
+        self.assertTrue(allclose(test.i, second.i))
+        self.assertEqual(test.idev, None)
+        self.assertRaises(AssertionError, loadsasxml, path, 2)
+
+        # every entry has the elements the schema requires
+        source = open_sas_file(path)
+        root = ET.parse(source).getroot()
+        source.close()
+        for sas_entry in root.findall('{cansas1d/1.0}SASentry'):
+            for tag in ['Title', 'Run', 'SASdata', 'SASsample',
+                        'SASinstrument']:
+                self.assertTrue(
+                        sas_entry.find('{cansas1d/1.0}' + tag) is not None)
+            self.assertEqual(sas_entry.find(
+                    '{cansas1d/1.0}SASinstrument/{cansas1d/1.0}SASsource/'
+                    '{cansas1d/1.0}radiation').text, 'x-ray')
+
+        # the existing example file survives a round trip
+        original = loadsasxml('xmltest.xml')
+        path = os.path.join(self.test_dir, 'copy.xml')
+        savesasxml(original, path)
+        test = loadsasxml(path)
+        self.assertTrue(allclose(test.q, original.q))
+        self.assertTrue(allclose(test.i, original.i))
+        self.assertTrue(allclose(test.idev, original.idev))
+
+        # units with % in them are written as they are
+        savesasxml(self.test_data, path, q_unit='%', i_unit='a.u. %d')
+        source = open_sas_file(path)
+        data_point = ET.parse(source).getroot().find(
+                '{cansas1d/1.0}SASentry/{cansas1d/1.0}SASdata/'
+                '{cansas1d/1.0}Idata')
+        source.close()
+        self.assertEqual(data_point.find('{cansas1d/1.0}Q').get('unit'), '%')
+        self.assertEqual(data_point.find('{cansas1d/1.0}Idev').get('unit'),
+                         'a.u. %d')
+        self.assertTrue(allclose(loadsasxml(path).i, self.test_data.i))
+
+    def test_sasxml_many_entries(self):
+        """Tests reading single entries from a file with many of them."""
+
+        frames = [self.test_data * (j + 1.) for j in range(300)]
+        path = os.path.join(self.test_dir, 'many.xml.gz')
+        savesasxml(frames, path)
+
+        start_time = time.time()
+        for j in [0, 150, 299]:
+            test = loadsasxml(path, j)
+            self.assertTrue(allclose(test.i, frames[j].i))
+            self.assertEqual(len(test), len(self.test_data))
+        self.assertTrue(time.time() - start_time < 10.)
+        self.assertRaises(AssertionError, loadsasxml, path, 300)
+
+        # or all of them in one pass
+        test = list(iter_sasxml(path))
+        self.assertEqual(len(test), len(frames))
+        self.assertTrue(allclose(test[-1].i, frames[-1].i))
+        self.assertEqual(len(list(iter_sasxml(path, 298))), 2)
+
 if __name__ == '__main__':
     unittest.main()
 
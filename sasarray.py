@@ -0,0 +1,47 @@
+# sasarray
+# array routines shared by sas and the legacy modules, needing only numpy
+
+from numpy import asarray, ones, shape
+
+
+def range_mask(q, mask_ranges):
+    """Returns a boolean mask which is False for q in any of mask_ranges.
+
+    Mask_ranges takes the form of a list of length N of lists of length
+    two giving the low and high q of each range to exclude. Used by
+    ExpSasData.make_mask and by the legacy sastrim.generate_mask.
+    """
+
+    assert len(shape(mask_ranges)) == 2 and (
+            shape(mask_ranges)[1] == 2), 'mask ranges should be N x 2'
+
+    q = asarray(q)
+    mask = ones(len(q), dtype=bool)
+    for low, high in mask_ranges:
+        mask &= (q < low) | (q > high)
+
+    return mask
+
+
+def data_columns(data):
+    """Returns q, i and idev for a SasData object or an N x 2/N x 3 array.
+
+    Lets routines written for N x 2 arrays take SasData objects as well.
+    Anything with q and i attributes is taken to be a SasData object so
+    that sas need not be imported here. The returned arrays are the
+    object's own arrays or views of the columns of the array so nothing
+    is copied. idev is None if there are no errors.
+    """
+
+    if hasattr(data, 'q') and hasattr(data, 'i'):
+        return data.q, data.i, getattr(data, 'idev', None)
+
+    data = asarray(data)
+    assert data.ndim == 2 and data.shape[1] in (2, 3
+            ), 'data should be an N x 2 or N x 3 array'
+
+    idev = None
+    if data.shape[1] == 3:
+        idev = data[:,2]
+
+    return data[:,0], data[:,1], idev
@@ -4,6 +4,7 @@
 from scipy import *
 from scipy.optimize import *
 from scipy.io import read_array
+from sasarray import data_columns
 import unittest
 
 #definitions for specific models   
@@ -30,8 +31,8 @@ def guinier_residuals(param, i, q):
 #Least squares fitting routine for Guinier
 def fit_guinier(data):
     
-    i=data[:,1] # Pass data from 2d array to two times 1d
-    q=data[:,0]
+    # Take q and i from a 2d array or SasData object without copying
+    q, i, idev = data_columns(data)
 
     param_0 = array([1,1,0]) # Set reasonable initial values for Guinier fit
            
@@ -5,11 +5,11 @@ from scipy import *
 from scipy.optimize import *
 from scipy.io import read_array
 import matplotlib.pyplot as plt
+from sasarray import data_columns
 
 def plot_guinier(plot_data):
 
-    q_plot = plot_data[:,0]
-    i_plot = plot_data[:,1]
+    q_plot, i_plot, i_errors = data_columns(plot_data)
 
     q_plot_sq = q_plot**2
     log_i_plot = log(i_plot)
@@ -21,8 +21,7 @@ def plot_guinier(plot_data):
 
 def plot_loglog(plot_data):
 
-    q_plot = plot_data[:,0]
-    i_plot = plot_data[:,1]
+    q_plot, i_plot, i_errors = data_columns(plot_data)
 
     plt.loglog(q_plot, i_plot, 'ro')
     plt.ylabel('I')
@@ -1,34 +1,38 @@
 # sastrim
 # routines for trimming and processing scattering curves
         
+import copy
 import numpy as np
-import copy as cp
+from sasarray import data_columns, range_mask
 
 def mask_data(data_to_mask, mask):
-    q = data_to_mask[:,0]
-    i = data_to_mask[:,1]
+    # takes an N x 2 (or N x 3) array or a SasData object and returns
+    # the same kind of thing with the masked points removed
+    q, i, idev = data_columns(data_to_mask)
+    mask = np.asarray(mask, dtype=bool)
 
-    q_masked = np.extract(mask, q)
-    i_masked = np.extract(mask, i)
+    # ExpSasData objects are masked by apply_mask on a copy, keeping
+    # qdev and the full q grid for smearing without changing their mask
+    if hasattr(data_to_mask, 'apply_mask'):
+        masked_data = copy.copy(data_to_mask)
+        masked_data.mask = mask
+        return masked_data.apply_mask()
 
-    masked_data = np.column_stack((q_masked,i_masked))
+    # other SasData objects are remade as their own class, so that only
+    # numpy and not the whole of sas has to be imported here
+    if hasattr(data_to_mask, 'q'):
+        return type(data_to_mask)(q[mask], i[mask], dtype=i.dtype)
+
+    masked_data = np.compress(mask, data_to_mask, axis=0)
 
     return masked_data
 
 
 def generate_mask(data_to_mask, mask_ranges):
-    q_mask = data_to_mask[:,0]
-    mask = cp.deepcopy(q_mask) # copy the q list because we will change it    
-
-    for i in range(0,len(mask)):
-        for low, high in mask_ranges:
-            if q_mask[i] >= low and q_mask[i] <= high:
-                mask[i] = 0
-                break
-            else:
-                mask[i] = 1 
-
-    return mask
+    # works on N x 2 arrays or SasData objects without copying the q values
+    q_mask, i, idev = data_columns(data_to_mask)
+
+    return range_mask(q_mask, mask_ranges)
 
 
 